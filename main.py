@@ -4,7 +4,9 @@ load_dotenv()
 import logging
 logger = logging.getLogger('chatbot')
 
-from pontozobiztos.HomoBot import HomoBot
+from pontozobiztos import startup_profiler
+with startup_profiler.measure('import HomoBot'):
+    from pontozobiztos.HomoBot import HomoBot
 
 
 if __name__ == "__main__":
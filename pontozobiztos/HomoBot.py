@@ -1,7 +1,10 @@
-from . import chatmongo, plugins, chatscheduler
+from . import chatmongo, plugins, chatscheduler, eventqueue, triggers
+from . import lazy, mediastore, startup_profiler
 from apscheduler.jobstores.base import JobLookupError
 from .models import User
 import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import fbchat
 import os
@@ -22,6 +25,15 @@ logger.setLevel(logging.DEBUG)
 
 COOKIES_LOC = "/chatbot_data/cookies"
 BOT_RESET_TIME = 15 * 60  # seconds
+PLUGIN_WORKERS = int(os.getenv('PLUGIN_WORKERS', 4))
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', 1000))
+QUEUE_STATS_INTERVAL = 5 * 60  # seconds
+MEDIA_SWEEP_INTERVAL = 30 * 60  # seconds
+MEDIA_SWEEP_BATCH = 100  # messages per sweep
+SYNC_PAGE_SIZE = 200
+SYNC_CHECKPOINT = 'sync_ranges'
+# create the lazy clients and indexes in the background after startup
+WARM_UP = os.getenv('WARM_UP', '1') == '1'
 
 logformat = "%(asctime)s.%(msecs)03d [%(levelname)s] <%(module)s> %(funcName)s(): %(message)s"
 dateformat = "%Y-%m-%d %H:%M:%S"
@@ -44,7 +56,8 @@ logger.addHandler(ch)
 logger.info("Importing plugins from plugins folder...")
 plugin_dict = {}
 for module in plugins.__all__:
-    plugin = importlib.import_module("pontozobiztos.plugins." + module)
+    with startup_profiler.measure('import plugin ' + module):
+        plugin = importlib.import_module("pontozobiztos.plugins." + module)
     try:
         logger.info(f"Added module {module} to active plugins")
         plugin_dict[module] = plugin
@@ -52,13 +65,16 @@ for module in plugins.__all__:
         logger.warning(f"Plugin '{module}' has no attribute 'ENABLED'.")
         del plugin
 
+plugin_index = triggers.TriggerIndex(plugin_dict)
+
 
 def init_plugins(thread: fbchat.GroupData, *args, **kwargs):
     """Initializes plugins in    plugin_dict"""
     logger.info("Initializing plugins...")
     for name, obj in plugin_dict.items():
         try:
-            obj.init(thread, *args, **kwargs)
+            with startup_profiler.measure('init plugin ' + name):
+                obj.init(thread, *args, **kwargs)
         except (TypeError, AttributeError):
             logger.warning("Plugin '{}' could not be initialized "
                            "because it doesn't implement 'init'.".format(name))
@@ -79,17 +95,19 @@ class HomoBot(fbchat.Session):
     group: fbchat.GroupData
     client: fbchat.Client
     reset_job: Job = None
+    events: eventqueue.EventQueue = None
 
     @classmethod
     def create(cls):
         logger.info("Logging in...")
-        try:
-            with open(COOKIES_LOC, "rb") as cookies:
-                session_cookies = pickle.load(cookies)
-            self = cls.from_cookies(session_cookies)
-        except (FileNotFoundError, pickle.UnpicklingError):
-            self = cls.login(os.getenv('EMAIL'),
-                             os.getenv('PASSWORD'))
+        with startup_profiler.measure('login'):
+            try:
+                with open(COOKIES_LOC, "rb") as cookies:
+                    session_cookies = pickle.load(cookies)
+                self = cls.from_cookies(session_cookies)
+            except (FileNotFoundError, pickle.UnpicklingError):
+                self = cls.login(os.getenv('EMAIL'),
+                                 os.getenv('PASSWORD'))
 
         logger.info(f"Starting facebook client. ENABLED: {self.ENABLED}; "
                     f"SILENT: {self.SILENT}")
@@ -100,12 +118,20 @@ class HomoBot(fbchat.Session):
         logger.debug("Cookies saved with pickle protocol")
 
         self.client = fbchat.Client(session=self)
-        self.group = next(self.client.fetch_thread_info([self.GROUP_ID]))
-
-
+        with startup_profiler.measure('fetch group info'):
+            self.group = next(self.client.fetch_thread_info([self.GROUP_ID]))
+
+        with startup_profiler.measure('create db indexes'):
+            chatmongo.create_indexes()
+        with startup_profiler.measure('migrate embedded points'):
+            chatmongo.migrate_embedded_points()
+        with startup_profiler.measure('clean up media store'):
+            mediastore.cleanup_temp()
         self.schedule_reset()
-        self.update_users()
-        self.sync_database()
+        with startup_profiler.measure('update users'):
+            self.update_users()
+        with startup_profiler.measure('add sync range'):
+            self.add_sync_range()
 
         init_plugins(thread=self.group)
 
@@ -123,11 +149,54 @@ class HomoBot(fbchat.Session):
         listener = fbchat.Listener(session=self,
                                    chat_on=False,
                                    foreground=False)
+        self.events = eventqueue.EventQueue(self.handle_event,
+                                            workers=PLUGIN_WORKERS,
+                                            maxsize=EVENT_QUEUE_SIZE)
+        self.events.start()
+        threading.Thread(target=self.sync_database, name='sync',
+                         daemon=True).start()
+        chatscheduler.get_scheduler().add_job(
+            self.log_queue_stats, 'interval', seconds=QUEUE_STATS_INTERVAL)
+        chatscheduler.get_scheduler().add_job(
+            chatmongo.compact_multipliers, 'cron', hour=4)
+        # repairs the season totals in the background instead of delaying
+        # the start, then every night
+        chatscheduler.get_scheduler().add_job(
+            chatmongo.rebuild_season_totals, 'cron', hour=4, minute=30,
+            next_run_time=datetime.now())
+        # first run right after the start, then periodically
+        chatscheduler.get_scheduler().add_job(
+            self.sweep_media, 'interval', seconds=MEDIA_SWEEP_INTERVAL,
+            next_run_time=datetime.now())
+
+        startup_profiler.report()
+        if WARM_UP:
+            lazy.start_warm_up()
+
         logger.info('Listening...')
         for event in listener.listen():
             self.schedule_reset()
             if isinstance(event, fbchat.ThreadEvent):
-                self.handle_event(event)
+                self.events.put(event, event.thread.id)
+
+    def sweep_media(self):
+        """Downloads the media that was left pending by a restart or
+        failed before. The messages are fetched again, the download urls
+        of the stored ones might have expired."""
+        mids = chatmongo.find_unfinished_media(limit=MEDIA_SWEEP_BATCH)
+        if not mids:
+            return
+        logger.info(f'Retrying the media of {len(mids)} messages')
+        messages = []
+        for mid in mids:
+            try:
+                messages.append(fbchat.Message(thread=self.group, id=mid).fetch())
+            except fbchat.FacebookError as e:
+                logger.warning(f'Could not fetch message {mid}: {e}')
+        chatmongo.insert_or_update_messages(messages)
+
+    def log_queue_stats(self):
+        logger.info(f'Event queue stats: {self.events.get_stats()}')
 
     def handle_event(self, event: fbchat._events.Event) -> bool:
         if (isinstance(event, fbchat.MessageEvent)
@@ -154,11 +223,12 @@ class HomoBot(fbchat.Session):
 
             # don't run plugins on bot's messages
             # if event.author.id != self.user.id:
-            for name, mod in plugin_dict.items():
-                logger.debug('Running plugin: ' + name)
-                # try:
-                mod.on_message(message=msg,
-                               author=User.User(event.author.id))
+            for name, mod in plugin_index.match(msg):
+                # plugins that need the messages in order get them one
+                # by one, the others run in parallel on any worker
+                key = (thread.id, name) if getattr(mod, 'ORDERED', False) else None
+                self.events.submit(self.run_plugin, name, mod, msg,
+                                   event.author.id, key=key)
             else:
                 return False
         elif isinstance(event, fbchat.ReactionEvent):
@@ -166,6 +236,11 @@ class HomoBot(fbchat.Session):
                                    event.reaction)
         return False
 
+    @staticmethod
+    def run_plugin(name, mod, msg, author_id):
+        logger.debug('Running plugin: ' + name)
+        mod.on_message(message=msg, author=User.User(author_id))
+
     def get_group_user_data(self):
         ids = [p.id for p in self.group.participants]
 
@@ -184,7 +259,8 @@ class HomoBot(fbchat.Session):
         (ID, username, nickname w/o points)
         """
         logger.debug("Cross-checking facebook data with database")
-        for ud in self.get_group_user_data():
+        user_data = self.get_group_user_data()
+        for ud in user_data:
             chatmongo.update_or_add_user(*ud)
 
         admin_id = os.getenv('ADMIN_ID')
@@ -192,22 +268,68 @@ class HomoBot(fbchat.Session):
             logger.debug(f"Setting admin state for {admin_id}")
             chatmongo.update_info(admin_id, 'is_admin', True)
 
-    def sync_database(self):
-        logger.debug("Synchronizing database with facebook")
+        User.User.preload(*(ud[0] for ud in user_data))
+
+    def add_sync_range(self):
+        """Saves the gap between the latest stored message and now to
+        the sync checkpoint. Has to run before the listener starts
+        inserting new messages."""
         try:
             latest_msg_ts = chatmongo.get_latest_message().created_at
         except StopIteration:
             latest_msg_ts = datetime(year=2000, month=1, day=1, tzinfo=utc)
-        before = datetime.now(tz=utc)
-        while before > latest_msg_ts:
-            data = self.group._fetch_messages(200, before)
-            if len(data) <= 1:  # reached the first message
-                logger.info('No more messages. Last before: ' + str(before))
-                break
-            for msg in data[::-1]:  # reverse order will make it restart proof
-                chatmongo.insert_or_update_message(msg)
-                before = msg.created_at
-            # time.sleep(random.uniform(0, 3))
+        ranges = chatmongo.get_var(SYNC_CHECKPOINT, [])
+        ranges.append({'before': datetime.now(tz=utc),
+                       'after': latest_msg_ts})
+        chatmongo.set_var(SYNC_CHECKPOINT, ranges)
+
+    def sync_database(self):
+        """Fills the gaps saved in the sync checkpoint. The progress is
+        checkpointed after every page, so a restart continues where
+        the previous run stopped."""
+        logger.debug("Synchronizing database with facebook")
+        ranges = chatmongo.get_var(SYNC_CHECKPOINT, [])
+        while ranges:
+            try:
+                self.sync_range(ranges)
+            except Exception as e:
+                logger.exception(f'Synchronization failed: {e}')
+                return
+            ranges.pop(0)
+            chatmongo.set_var(SYNC_CHECKPOINT, ranges)
+        logger.info('Database is synchronized')
+
+    def sync_range(self, ranges):
+        """Fetches the messages of ranges[0] backwards from its 'before'
+        until its 'after' date. The next page is fetched while the
+        current one is being written.
+
+        Args:
+            ranges (list): list of {'before': datetime, 'after': datetime}
+                dicts. The first one is synchronized.
+        """
+        current = ranges[0]
+        before = utc.localize(current['before']) \
+            if current['before'].tzinfo is None else current['before']
+        after = utc.localize(current['after']) \
+            if current['after'].tzinfo is None else current['after']
+        logger.info(f'Synchronizing messages between {after} and {before}')
+
+        with ThreadPoolExecutor(max_workers=1) as fetcher:
+            page = fetcher.submit(self.group._fetch_messages,
+                                  SYNC_PAGE_SIZE, before)
+            while page is not None:
+                data = page.result()
+                if len(data) <= 1:  # reached the first message
+                    logger.info('No more messages. Last before: ' + str(before))
+                    break
+                before = min(msg.created_at for msg in data)
+                page = fetcher.submit(self.group._fetch_messages,
+                                      SYNC_PAGE_SIZE, before) \
+                    if before > after else None
+                chatmongo.insert_or_update_messages(data)
+                current['before'] = before
+                chatmongo.set_var(SYNC_CHECKPOINT, ranges)
 
 
 class ResetException(Exception):
@@ -7,17 +7,24 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import pymongo
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
 import logging
+import threading
 from pontozobiztos import utils
+from pontozobiztos import mediaworker
+from pontozobiztos import mediastore
+from pontozobiztos import imageindex
+from pontozobiztos import imagehashing
+from pontozobiztos.multiplierindex import MultiplierIndex
 import fbchat
 from fbchat import ShareAttachment, ImageAttachment, Mention, Attachment, MessageData, Message, Image, AudioAttachment, VideoAttachment
-import requests
 import pytz
 import os
+import io
+import re
 
 # import urllib
-import pathlib
 logger = logging.getLogger("chatbot")
 
 client = pymongo.MongoClient(host=os.getenv('MONGO_HOST'),
@@ -26,6 +33,37 @@ db = client.chat
 user_coll = db.users
 message_coll: pymongo.collection.Collection = db.messages
 persistent_coll: pymongo.collection.Collection = db.persistent
+point_coll: pymongo.collection.Collection = db.points
+season_coll: pymongo.collection.Collection = db.season_points
+media_coll: pymongo.collection.Collection = db.media_paths
+link_cache_coll: pymongo.collection.Collection = db.link_conversions
+artist_coll: pymongo.collection.Collection = db.artists
+
+USER_INFO_PROJECTION = {'_id': 1,
+                        'fullname': 1,
+                        'nickname': 1,
+                        'last_read_at': 1,
+                        'profile_picture': 1,
+                        'is_admin': 1,
+                        'is_pontozo': 1}
+
+# user_id -> user info document. Every write to a user through this
+# module updates or invalidates the cached document.
+_user_cache = {}
+# user_id -> number of writes, a document read from the db is only
+# cached if there was no write to the user while it was being read
+_user_versions = {}
+_user_cache_lock = threading.Lock()
+
+# attachment uid -> path of the saved media file
+_media_paths = {}
+_media_lock = threading.Lock()
+
+# user_id -> MultiplierIndex of the active multipliers
+_multiplier_indexes = {}
+# user_id -> number of set_multiplier calls, see _user_versions
+_multiplier_versions = {}
+_multiplier_lock = threading.Lock()
 
 def get_database():
     """Return chat database"""
@@ -42,6 +80,23 @@ def get_message_collection():
     return message_coll
 
 
+def get_point_collection():
+    """Return points ledger collection from chat database"""
+    return point_coll
+
+
+def create_indexes():
+    """Creates the indexes of the collections if they don't exist"""
+    point_coll.create_index([('user_id', pymongo.ASCENDING),
+                             ('timestamp', pymongo.ASCENDING)])
+    # rebuild_season_totals selects a season by timestamp only
+    point_coll.create_index('timestamp')
+    season_coll.create_index([('season_start', pymongo.ASCENDING),
+                              ('user_id', pymongo.ASCENDING)], unique=True)
+    # every cached conversion is removed by mongo at its own expires_at
+    link_cache_coll.create_index('expires_at', expireAfterSeconds=0)
+
+
 # USER FUNCTIONS
 
 def get_user(user_id):
@@ -65,25 +120,62 @@ def get_user_info(user_id):
         - fullname
         - nickname
 
+    The result is served from the user cache if possible.
+
     Args:
         user_id (str): facebook user_id
 
     Returns:
         dict: user information
     """
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached is not None:
+            return dict(cached)
+        version = _user_versions.get(user_id, 0)
+
     try:
-        return user_coll.find({'_id': user_id},
-                              {'_id': 1,
-                               'fullname': 1,
-                               'nickname': 1,
-                               'last_read_at': 1,
-                               'profile_picture': 1,
-                               'is_admin': 1,
-                               'is_pontozo': 1
-                               }
-                              ).next()
+        info = user_coll.find({'_id': user_id}, USER_INFO_PROJECTION).next()
     except StopIteration:
         return {}
+    with _user_cache_lock:
+        if _user_versions.get(user_id, 0) == version:
+            _user_cache[user_id] = info
+    return dict(info)
+
+
+def get_users_info(*user_ids):
+    """Returns basic information about many users. Users that are not
+    cached yet are loaded with a single query.
+
+    Args:
+        user_ids (str): facebook user_ids
+
+    Returns:
+        dict: user_id -> user information (missing users are left out)
+    """
+    with _user_cache_lock:
+        result = {uid: dict(_user_cache[uid]) for uid in user_ids
+                  if uid in _user_cache}
+        versions = {uid: _user_versions.get(uid, 0) for uid in user_ids
+                    if uid not in result}
+    missing = list(versions)
+    if missing:
+        loaded = list(user_coll.find({'_id': {'$in': missing}},
+                                     USER_INFO_PROJECTION))
+        with _user_cache_lock:
+            for info in loaded:
+                if _user_versions.get(info['_id'], 0) == versions[info['_id']]:
+                    _user_cache[info['_id']] = info
+        result.update({info['_id']: dict(info) for info in loaded})
+    return result
+
+
+def invalidate_user(user_id):
+    """Removes a user from the user cache"""
+    with _user_cache_lock:
+        _user_cache.pop(user_id, None)
+        _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
 
 
 def get_user_ids():
@@ -123,13 +215,13 @@ def update_or_add_user(user_id, fullname, nickname, profile_picture, last_read_a
                                     'last_read_at': last_read_at,
                                   },
                                   '$setOnInsert': {
-                                      'points': [],
                                       'multipliers': [],
                                       'is_admin': False,
                                       'is_pontozo': False
                                   }},
                                   upsert=True)
 
+    invalidate_user(user_id)
     upserted = bool(update.upserted_id)
     if upserted:
         logger.info(f"New user was added to the database with name: {fullname},"
@@ -156,6 +248,13 @@ def update_info(user_id, field, value):
                                   {'$set': {
                                       field: value
                                   }})
+    with _user_cache_lock:
+        _user_versions[user_id] = _user_versions.get(user_id, 0) + 1
+        cached = _user_cache.get(user_id)
+        if cached is not None and field in USER_INFO_PROJECTION:
+            cached[field] = value
+        elif cached is not None:
+            del _user_cache[user_id]
     return bool(update.modified_count)
 
 
@@ -174,35 +273,17 @@ def get_points(user_id, from_date=None, to_date=None):
     from_date = from_date or utils.get_season_start()
     to_date = to_date or utils.get_season_end()
 
-    pipeline = [
-        {'$match': {'_id': user_id}},
-        {'$project': {'points': 1}},
-        {'$unwind': '$points'},
-        {'$project': {
-            'points': 1,
-            'is_between_dates': {
-                '$allElementsTrue': [
-                    [
-                        {'$gte': ['$points.timestamp', from_date]},
-                        {'$lt': ['$points.timestamp', to_date]}
-                    ]
-                ]
-            }
-        }},
-        {'$match': {'is_between_dates': True}},
-        {'$group': {
-            '_id': None,
-            'points': {'$push': '$points'}
-        }}
-    ]
-    try:
-        return user_coll.aggregate(pipeline).next()["points"]
-    except StopIteration:
-        return []
+    cursor = point_coll.find(
+        {'user_id': user_id,
+         'timestamp': {'$gte': from_date, '$lt': to_date}},
+        {'_id': 0, 'user_id': 0, 'legacy_index': 0}
+    ).sort([('timestamp', 1)])
+    return list(cursor)
 
 
 def get_points_sum(user_id: str, from_date=None, to_date=None):
-    """Calculates the sum of points between from_date and to_date
+    """Calculates the sum of points between from_date and to_date.
+    The sum of the current season is read from the season totals.
 
     Args:
         user_id (str): facebook user_id
@@ -213,32 +294,26 @@ def get_points_sum(user_id: str, from_date=None, to_date=None):
         float: Sum of points (from_date - to_date)
             (None if not found)
     """
+    if from_date is None and to_date is None:
+        season = season_coll.find_one(
+            {'user_id': user_id, 'season_start': utils.get_season_start()})
+        return season['total'] if season else 0
+
     from_date = from_date or utils.get_season_start()
     to_date = to_date or utils.get_season_end()
 
     pipeline = [
-        {'$match': {'_id': user_id}},
-        {'$project': {'points': 1}},
-        {'$unwind': '$points'},
-        {'$project': {
-            'points': 1,
-            'is_between_dates': {
-                '$allElementsTrue': [
-                    [
-                        {'$gte': ['$points.timestamp', from_date]},
-                        {'$lt': ['$points.timestamp', to_date]}
-                    ]
-                ]
-            }
+        {'$match': {
+            'user_id': user_id,
+            'timestamp': {'$gte': from_date, '$lt': to_date}
         }},
-        {'$match': {'is_between_dates': True}},
         {'$group': {
             '_id': None,
-            'total': {'$sum': '$points.value'}
+            'total': {'$sum': '$value'}
         }}
     ]
     try:
-        return user_coll.aggregate(pipeline).next()["total"]
+        return point_coll.aggregate(pipeline).next()["total"]
     except StopIteration:
         return 0
 
@@ -257,23 +332,139 @@ def add_points(user_id, value, source, ts=None, mid=None, desc=""):
     Returns:
         bool: True if addition is successful, otherwise False
     """
+    # the ledger and the season total are separate writes (the db is
+    # not a replica set, no transactions). If the bot stops between
+    # them, the total is rebuilt from the ledger at the next start.
+    if not get_user_info(user_id):
+        logger.warning(f'Could not add points. User {user_id} not found.')
+        return False
+
     ts = ts or datetime.today()
-    update = user_coll.update_one(
-        {'_id': user_id},
-        {'$push': {
-            'points': {
-                'value': value,
-                'source': source,
-                'timestamp': ts,
-                'description': desc,
-                'mid': mid
-            }
-        }}
+    insert = point_coll.insert_one({
+        'user_id': user_id,
+        'value': value,
+        'source': source,
+        'timestamp': ts,
+        'description': desc,
+        'mid': mid
+    })
+    season_start = utils.get_season_start(ts)
+    season_coll.update_one(
+        {'user_id': user_id, 'season_start': season_start},
+        {'$inc': {'total': value},
+         '$setOnInsert': {'season_end': utils.get_season_end(season_start)}},
+        upsert=True
     )
     logger.info(f'Inserted {value} points for user {user_id}. '
                 f'Source: {source}. Timestamp: {ts}, Description: {desc}.'
                 f'MID: {mid}')
-    return bool(update.modified_count)
+    return bool(insert.inserted_id)
+
+
+def rebuild_season_totals(date=None):
+    """Recalculates the season totals of every user from the points
+    ledger for the season containing date.
+
+    Args:
+        date (datetime): a date in the season (default: now)
+
+    Returns:
+        int: number of users with points in the season
+    """
+    season_start = utils.get_season_start(date)
+    season_end = utils.get_season_end(season_start)
+    # add_points counts a point to the season started before it, also
+    # the points between the season end (19:50) and the next start
+    next_start = season_start + relativedelta(months=1)
+    totals = list(point_coll.aggregate([
+        {'$match': {'timestamp': {'$gte': season_start, '$lt': next_start}}},
+        {'$group': {'_id': '$user_id', 'total': {'$sum': '$value'}}}
+    ]))
+    # replaced in place, so the totals can be read during the rebuild
+    if totals:
+        season_coll.bulk_write([
+            pymongo.UpdateOne({'user_id': t['_id'], 'season_start': season_start},
+                              {'$set': {'season_end': season_end,
+                                        'total': t['total']}},
+                              upsert=True)
+            for t in totals
+        ], ordered=False)
+    season_coll.delete_many({'season_start': season_start,
+                             'user_id': {'$nin': [t['_id'] for t in totals]}})
+    logger.info(f'Rebuilt season totals of {len(totals)} users for season '
+                f'{season_start} - {season_end}')
+    return len(totals)
+
+
+def get_leaderboard(date=None):
+    """Returns every user with their season total in one query,
+    sorted by the total descending.
+
+    Args:
+        date (datetime): a date in the season (default: now)
+
+    Returns:
+        list: list of dicts with _id, fullname and points
+    """
+    season_start = utils.get_season_start(date)
+    pipeline = [
+        {'$project': {'fullname': 1}},
+        {'$lookup': {
+            'from': season_coll.name,
+            'let': {'uid': '$_id'},
+            'pipeline': [
+                {'$match': {'$expr': {'$and': [
+                    {'$eq': ['$season_start', season_start]},
+                    {'$eq': ['$user_id', '$$uid']}
+                ]}}},
+                {'$project': {'total': 1}}
+            ],
+            'as': 'season'
+        }},
+        {'$project': {
+            'fullname': 1,
+            'points': {'$sum': '$season.total'}
+        }},
+        {'$sort': {'points': -1}}
+    ]
+    return list(user_coll.aggregate(pipeline))
+
+
+def migrate_embedded_points(batch_size=1000):
+    """Moves the points embedded in the user documents ('points' array)
+    to the points ledger collection, and rebuilds the season totals of
+    the seasons they belong to. Points are upserted by the user and
+    their index in the array (identical points are kept apart), so the
+    migration can be rerun safely if it's interrupted.
+
+    Args:
+        batch_size (int): number of points written in one bulk write
+
+    Returns:
+        int: number of migrated points
+    """
+    create_indexes()
+    migrated = 0
+    seasons = set()
+    for user in user_coll.find({'points.0': {'$exists': True}},
+                               {'points': 1}):
+        points = user['points']
+        for i in range(0, len(points), batch_size):
+            batch = points[i:i + batch_size]
+            point_coll.bulk_write([
+                pymongo.UpdateOne({'user_id': user['_id'], 'legacy_index': i + n},
+                                  {'$setOnInsert': point},
+                                  upsert=True)
+                for n, point in enumerate(batch)
+            ], ordered=False)
+        user_coll.update_one({'_id': user['_id']}, {'$unset': {'points': ''}})
+        seasons.update(utils.get_season_start(p['timestamp']) for p in points
+                       if isinstance(p.get('timestamp'), datetime))
+        migrated += len(points)
+        logger.info(f'Migrated {len(points)} points of user {user["_id"]}')
+    for season_start in sorted(seasons):
+        rebuild_season_totals(season_start)
+    return migrated
 
 
 def set_multiplier(user_id, value, typename, expiration_date):
@@ -309,9 +500,86 @@ def set_multiplier(user_id, value, typename, expiration_date):
                 'multipliers.$.value': value
             }}
         )
+    invalidate_user(user_id)
+    with _multiplier_lock:
+        _multiplier_versions[user_id] = _multiplier_versions.get(user_id, 0) + 1
+        index = _multiplier_indexes.get(user_id)
+        if index is not None:
+            index.set(typename, value, expiration_date)
     return bool(update.modified_count)
 
 
+def get_multiplier(user_id):
+    """Returns the product of the active multipliers of a user. The
+    multipliers are loaded from the db only once, after that they are
+    kept up to date in memory.
+
+    Args:
+        user_id (str): facebook user_id
+
+    Returns:
+        float: product of active multipliers (1.0 if there is none)
+    """
+    while True:
+        with _multiplier_lock:
+            index = _multiplier_indexes.get(user_id)
+            if index is not None:
+                return index.product()
+            version = _multiplier_versions.get(user_id, 0)
+        doc = user_coll.find_one({'_id': user_id}, {'multipliers': 1}) or {}
+        index = MultiplierIndex(doc.get('multipliers', []))
+        with _multiplier_lock:
+            # a set_multiplier during the read might be missing from it,
+            # read again
+            if _multiplier_versions.get(user_id, 0) == version:
+                _multiplier_indexes.setdefault(user_id, index)
+
+
+def get_users_multiplier(*user_ids):
+    """Returns the multiplier products of several users, like
+    get_multiplier, but the users not yet in memory are loaded with a
+    single query.
+
+    Args:
+        user_ids (str): facebook user_ids
+
+    Returns:
+        dict: user_id -> product of active multipliers
+    """
+    while True:
+        with _multiplier_lock:
+            missing = {uid: _multiplier_versions.get(uid, 0)
+                       for uid in user_ids if uid not in _multiplier_indexes}
+            if not missing:
+                return {uid: _multiplier_indexes[uid].product()
+                        for uid in user_ids}
+        docs = {doc['_id']: doc for doc in user_coll.find(
+            {'_id': {'$in': list(missing)}}, {'multipliers': 1})}
+        with _multiplier_lock:
+            for uid, version in missing.items():
+                # same as in get_multiplier, a user modified during the
+                # read is read again
+                if _multiplier_versions.get(uid, 0) == version:
+                    index = MultiplierIndex(
+                        docs.get(uid, {}).get('multipliers', []))
+                    _multiplier_indexes.setdefault(uid, index)
+
+
+def compact_multipliers():
+    """Removes the expired multipliers from every user document.
+
+    Returns:
+        int: number of modified user documents
+    """
+    update = user_coll.update_many(
+        {'multipliers.expiration_date': {'$lt': datetime.now()}},
+        {'$pull': {'multipliers': {'expiration_date': {'$lt': datetime.now()}}}}
+    )
+    logger.info(f'Removed expired multipliers from '
+                f'{update.modified_count} users')
+    return update.modified_count
+
+
 def get_multipliers(user_id, include_expired=False):
     """Returns a list of multiplier documents.
 
@@ -490,16 +758,166 @@ def get_messages_by_mid(*mids):
             message_coll.find({'_id': {'$in': mids}})]
 
 
+def register_media_path(uid, path, media_type):
+    """Stores the path of a saved media file in the media index.
+
+    Args:
+        uid (str): attachment id
+        path (str): path of the saved file
+        media_type (str): image, video or audio
+    """
+    if not uid:
+        return
+    media_coll.update_one({'_id': uid},
+                          {'$set': {'path': str(path), 'type': media_type}},
+                          upsert=True)
+    with _media_lock:
+        _media_paths[uid] = str(path)
+
+
+def get_media_path(uid):
+    """Returns the path of a saved media file from the media index.
+
+    Args:
+        uid (str): attachment id
+
+    Returns:
+        str: path of the file, None if it's not indexed
+    """
+    with _media_lock:
+        path = _media_paths.get(uid)
+    if path is None:
+        doc = media_coll.find_one({'_id': uid})
+        if doc is None:
+            return None
+        path = doc['path']
+        with _media_lock:
+            _media_paths[uid] = path
+    return path
+
+
+def rebuild_media_index(batch_size=1000):
+    """Rebuilds the media index from the attachments stored in the
+    messages collection.
+
+    Args:
+        batch_size (int): number of paths written in one bulk write
+
+    Returns:
+        int: number of indexed files
+    """
+    cursor = message_coll.aggregate([
+        {'$match': {'attachments.path': {'$exists': True}}},
+        {'$unwind': '$attachments'},
+        {'$match': {'attachments.path': {'$exists': True},
+                    'attachments.uid': {'$ne': None}}},
+        {'$project': {'_id': 0,
+                      'uid': '$attachments.uid',
+                      'path': '$attachments.path',
+                      'type': '$attachments.type'}}
+    ])
+    indexed = 0
+    operations = []
+    for att in cursor:
+        operations.append(pymongo.UpdateOne(
+            {'_id': att['uid']},
+            {'$set': {'path': att['path'], 'type': att['type']}},
+            upsert=True))
+        if len(operations) == batch_size:
+            media_coll.bulk_write(operations, ordered=False)
+            indexed += len(operations)
+            operations = []
+    if operations:
+        media_coll.bulk_write(operations, ordered=False)
+        indexed += len(operations)
+    with _media_lock:
+        _media_paths.clear()
+    logger.info(f'Indexed {indexed} media files')
+    return indexed
+
+
+def migrate_media_to_store(batch_size=500):
+    """Moves the media files of the stored attachments that are outside
+    of the media store (old flat directories) into the store, and
+    updates their path and digest in the messages and the media index.
+    The original files are removed only after the documents of their
+    batch are written, so it can be interrupted and rerun.
+
+    Args:
+        batch_size (int): number of attachments updated in one bulk write
+
+    Returns:
+        tuple: (migrated files, deduplicated files, missing files)
+    """
+    store_root = mediastore.get_backend().uri('')
+    # with the separator, so sibling directories like media_old are
+    # migrated too
+    if not store_root.endswith('/'):
+        store_root += '/'
+    cursor = message_coll.aggregate([
+        {'$match': {'attachments.path': {'$exists': True}}},
+        {'$unwind': '$attachments'},
+        {'$match': {'attachments.path': {'$exists': True,
+                                         '$not': re.compile('^' + re.escape(store_root))}}},
+        {'$project': {'uid': '$attachments.uid',
+                      'path': '$attachments.path',
+                      'type': '$attachments.type'}}
+    ])
+
+    migrated = deduplicated = missing = 0
+    message_ops, media_ops, originals = [], [], []
+
+    def flush():
+        if message_ops:
+            message_coll.bulk_write(message_ops, ordered=False)
+        if media_ops:
+            media_coll.bulk_write(media_ops, ordered=False)
+        # the messages point to the store now, the originals can go
+        for path in originals:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        message_ops.clear()
+        media_ops.clear()
+        originals.clear()
+
+    for att in cursor:
+        if not os.path.isfile(att['path']):
+            missing += 1
+            continue
+        blob = mediastore.store_file(att['path'])
+        originals.append(att['path'])
+        migrated += 1
+        deduplicated += blob.deduplicated
+        message_ops.append(pymongo.UpdateOne(
+            {'_id': att['_id'], 'attachments.uid': att['uid']},
+            {'$set': {'attachments.$.path': str(blob.path),
+                      'attachments.$.digest': blob.digest}}))
+        if att['uid']:
+            media_ops.append(pymongo.UpdateOne(
+                {'_id': att['uid']},
+                {'$set': {'path': str(blob.path), 'type': att['type']}},
+                upsert=True))
+        if len(message_ops) == batch_size:
+            flush()
+            logger.info(f'Migrated {migrated} media files '
+                        f'({deduplicated} deduplicated)')
+    flush()
+    with _media_lock:
+        _media_paths.clear()
+    logger.info(f'Migrated {migrated} media files, {deduplicated} were '
+                f'duplicates, {missing} were missing')
+    return migrated, deduplicated, missing
+
+
 def save_image(image_attachment: fbchat.ImageAttachment,
                created_at: datetime,
                mid: str,
                author: str):
-    """Save images found in a Message object. The path that the
-    image is saved to is stored back into the message_object in the
-    ImageAttachment as 'path'.
-
-    filename format:
-        YYYYmmddHHMMSS_<user_id>_<attachment_id>.<ext>
+    """Save images found in a Message object to the media store. The
+    image is streamed to the store and hashed from the downloaded bytes
+    in the same pass, so the file is never read back.
 
     Args:
         image_attachment (fbchat.ImageAttachment): fbchat.Message object
@@ -509,35 +927,25 @@ def save_image(image_attachment: fbchat.ImageAttachment,
         author (str): facebook user_id
 
     Returns:
-        None
+        tuple: (path of the saved image, dict of image hashes)
     """
-    img_dir = pathlib.Path(os.getenv("IMAGE_DIRECTORY"))
-    img_dir.mkdir(exist_ok=True)
-
-    fpath = img_dir / ('_'.join((created_at.strftime('%Y%m%d%H%M%S'),
-                                 'u' + author,
-                                 mid,
-                                 'a' + image_attachment.id))
-                       + '.' + image_attachment.original_extension)
-
     largest_image = sorted(list(image_attachment.previews),
                            key=lambda i: i.width or 0)[-1]
-    img = requests.get(largest_image.url, timeout=5)
-    open(fpath, 'wb').write(img.content)
-    logger.info(f"Image saved to path: {fpath}")
-    return str(fpath)
+    buffer = io.BytesIO()
+    with mediastore.BlobWriter(image_attachment.original_extension) as blob:
+        mediaworker.download(largest_image.url, blob, buffer)
+    logger.info(f"Image of message {mid} saved to path: {blob.path}"
+                f"{' (deduplicated)' if blob.deduplicated else ''}")
+    register_media_path(image_attachment.id, blob.path, 'image')
+    buffer.seek(0)
+    return str(blob.path), imagehashing.hash_images([buffer])[0]
 
 
 def save_video(video_attachment: fbchat.VideoAttachment,
                created_at: datetime,
                mid: str,
                author: str):
-    """Save images found in a Message object. The path that the
-    image is saved to is stored back into the message_object in the
-    ImageAttachment as 'path'.
-
-    filename format:
-        YYYYmmddHHMMSS_<user_id>_<attachment_id>.<ext>
+    """Save videos found in a Message object to the media store.
 
     Args:
         video_attachment (fbchat.VideoAttachment): fbchat.Message object
@@ -547,32 +955,21 @@ def save_video(video_attachment: fbchat.VideoAttachment,
         author (str): facebook user_id
 
     Returns:
-        None
+        str: path of the saved video
     """
-    img_dir = pathlib.Path(os.getenv("VIDEO_DIRECTORY"))
-    img_dir.mkdir(exist_ok=True)
-
-    fpath = img_dir / ('_'.join((created_at.strftime('%Y%m%d%H%M%S'),
-                                 'u' + author,
-                                 mid,
-                                 'a' + video_attachment.id)) + '.mp4')
-
-    vid = requests.get(video_attachment.preview_url, timeout=5)
-    open(fpath, 'wb').write(vid.content)
-    logger.info(f"Video saved to path: {fpath}")
-    return str(fpath)
+    with mediastore.BlobWriter('mp4') as blob:
+        mediaworker.download(video_attachment.preview_url, blob)
+    logger.info(f"Video of message {mid} saved to path: {blob.path}"
+                f"{' (deduplicated)' if blob.deduplicated else ''}")
+    register_media_path(video_attachment.id, blob.path, 'video')
+    return str(blob.path)
 
 
 def save_audio(audio_attachment: fbchat.AudioAttachment,
                created_at: datetime,
                mid: str,
                author: str):
-    """Save images found in a Message object. The path that the
-    image is saved to is stored back into the message_object in the
-    ImageAttachment as 'path'.
-
-    filename format:
-        YYYYmmddHHMMSS_<user_id>_<attachment_id>.<ext>
+    """Save audio files found in a Message object to the media store.
 
     Args:
         audio_attachment (fbchat.AudioAttachment): fbchat.Message object
@@ -582,20 +979,14 @@ def save_audio(audio_attachment: fbchat.AudioAttachment,
         author (str): facebook user_id
 
     Returns:
-        None
+        str: path of the saved audio
     """
-    img_dir = pathlib.Path(os.getenv("AUDIO_DIRECTORY"))
-    img_dir.mkdir(exist_ok=True)
-
-    fpath = img_dir / ('_'.join((created_at.strftime('%Y%m%d%H%M%S'),
-                                 'u' + author,
-                                 mid,
-                                 'a' + (audio_attachment.id or 'udio'))) + '.mp3')
-
-    img = requests.get(audio_attachment.url, timeout=5)
-    open(fpath, 'wb').write(img.content)
-    logger.info(f"Audio saved to path: {fpath}")
-    return str(fpath)
+    with mediastore.BlobWriter('mp3') as blob:
+        mediaworker.download(audio_attachment.url, blob)
+    logger.info(f"Audio of message {mid} saved to path: {blob.path}"
+                f"{' (deduplicated)' if blob.deduplicated else ''}")
+    register_media_path(audio_attachment.id, blob.path, 'audio')
+    return str(blob.path)
 
 
 def serialize_mentions(*mentions):
@@ -605,10 +996,73 @@ def serialize_mentions(*mentions):
     } for mention in mentions}
 
 
-def serialize_attachments(message: fbchat.Message):
+MEDIA_ATTACHMENTS = (ImageAttachment, VideoAttachment, AudioAttachment)
+MAX_DOWNLOAD_ATTEMPTS = 5
+MEDIA_SWEEP_AGE = 10 * 60  # seconds
+
+
+def is_media_persisted(att_dict):
+    """Checks whether a stored attachment document has its media file
+    already saved (and hashed in case of images).
+
+    Args:
+        att_dict (dict): attachment document from the db (or None)
+
+    Returns:
+        bool: True if the file doesn't have to be downloaded again
+    """
+    if not att_dict or not att_dict.get('path'):
+        return False
+    if att_dict.get('type') == 'image' and 'image_hash' not in att_dict:
+        return False
+    return mediastore.exists(att_dict['path'])
+
+
+def is_attachment_stored(att, stored):
+    """Checks whether an attachment is already stored completely, or
+    it's being downloaded right now.
+
+    Args:
+        att (fbchat.Attachment): attachment of the message
+        stored (dict): stored attachment documents by uid
+
+    Returns:
+        bool: True if nothing has to be done with the attachment
+    """
+    if att.id not in stored:
+        return False
+    if not isinstance(att, MEDIA_ATTACHMENTS):
+        return True
+    return (is_media_persisted(stored[att.id])
+            or mediaworker.get_pending(att.id) is not None)
+
+
+def serialize_attachments(message: fbchat.Message, stored=None):
+    """Serializes the attachments of a message. Media files are not
+    downloaded here: image, video and audio attachments are stored with
+    'status': 'pending' and download_attachments() fills in 'path' (and
+    'image_hash') later. Media that is already persisted in `stored`
+    keeps its saved fields.
+
+    Args:
+        message (fbchat.Message): message with the attachments
+        stored (dict): attachment documents already in the db by uid
+
+    Returns:
+        list: list of attachment dicts
+    """
+    stored = stored or {}
     rtn = []
     for att in message.attachments:
         att_dict = {'uid': att.id}
+        if stored.get(att.id, {}).get('attempts'):
+            # failed downloads are retried a limited number of times
+            att_dict['attempts'] = stored[att.id]['attempts']
+        if isinstance(att, MEDIA_ATTACHMENTS) \
+                and is_media_persisted(stored.get(att.id)):
+            att_dict.update({k: v for k, v in stored[att.id].items()
+                             if k in ('path', 'digest', 'image_hash', 'dhash', 'whash')})
+            att_dict['status'] = 'done'
         if isinstance(att, ShareAttachment):
             att_dict.update({
                 'type': 'share',
@@ -616,64 +1070,249 @@ def serialize_attachments(message: fbchat.Message):
                 'original_url': att.original_url
             })
         elif isinstance(att, ImageAttachment):
-            fpath = save_image(att, message.created_at, message.id, message.author)
-            img_hash = utils.hash_image(str(fpath))
             largest_image = sorted(list(att.previews), key=lambda i: i.width or 0)[-1]
+            att_dict.setdefault('status', 'pending')
             att_dict.update({
                 'type': 'image',
-                'path': fpath,
                 'original_extension': att.original_extension,
                 'preview_url': largest_image.url,
                 'preview_height': largest_image.height,
                 'preview_width': largest_image.width,
-                'image_hash': img_hash
             })
         elif isinstance(att, fbchat.VideoAttachment):
-            fpath = save_video(att, message.created_at, message.id, message.author)
+            att_dict.setdefault('status', 'pending')
             att_dict['type'] = 'video'
             att_dict['width'] = att.width
             att_dict['height'] = att.height
             att_dict['duration'] = att.duration.total_seconds()
             att_dict['size'] = att.size  # in bytes
-            att_dict['path'] = fpath
         elif isinstance(att, fbchat.AudioAttachment):
-            fpath = save_audio(att, message.created_at, message.id, message.author)
+            att_dict.setdefault('status', 'pending')
             att_dict['type'] = 'audio'
             att_dict['filename'] = att.filename
             att_dict['duration'] = att.duration.total_seconds()
             att_dict['audio_type'] = att.audio_type
-            att_dict['path'] = fpath
         else:
             att_dict['type'] = 'other'
         rtn.append(att_dict)
     return rtn
 
 
-def insert_or_update_message(message_object):
-    """Adds a message the user with text and image.
+def serialize_image_hashes(hashes):
+    """Maps the result of imagehashing to attachment fields. phash is
+    stored as 'image_hash' for compatibility.
+
+    Args:
+        hashes (dict): hash type -> hex string
+
+    Returns:
+        dict: attachment fields
+    """
+    return {('image_hash' if name == 'phash' else name): value
+            for name, value in hashes.items()}
+
+
+def download_attachment(att, created_at, mid, author):
+    """Downloads a single media attachment and stores its path (and
+    hash for images) in the message document.
+
+    Args:
+        att (fbchat.Attachment): image, video or audio attachment
+        created_at (datetime): datetime when the message was sent
+        mid (str): facebook message_id
+        author (str): facebook user_id
+
+    Returns:
+        dict: the fields that were set on the attachment
+    """
+    fields = {}
+    try:
+        if isinstance(att, ImageAttachment):
+            fields['path'], hashes = save_image(att, created_at, mid, author)
+            fields.update(serialize_image_hashes(hashes))
+            imageindex.get_index().add(fields['image_hash'], mid, created_at)
+        elif isinstance(att, fbchat.VideoAttachment):
+            fields['path'] = save_video(att, created_at, mid, author)
+        elif isinstance(att, fbchat.AudioAttachment):
+            fields['path'] = save_audio(att, created_at, mid, author)
+        fields['digest'] = mediastore.digest_of(fields['path'])
+        fields['status'] = 'done'
+    except Exception as e:
+        # anything (download, store, decode) leaves it for the sweep,
+        # see find_unfinished_media
+        logger.error(f'Could not download attachment {att.id} of '
+                     f'message {mid}: {e}')
+        fields = {'status': 'failed'}
+
+    update = {'$set': {'attachments.$.' + k: v for k, v in fields.items()}}
+    if fields['status'] == 'failed':
+        update['$inc'] = {'attachments.$.attempts': 1}
+    message_coll.update_one({'_id': mid, 'attachments.uid': att.id}, update)
+    return fields
+
+
+def find_unfinished_media(older_than=MEDIA_SWEEP_AGE, limit=None):
+    """Finds the messages with media attachments that are still
+    pending (the bot stopped before downloading them) or failed fewer
+    than MAX_DOWNLOAD_ATTEMPTS times. Attachments being downloaded right
+    now are left out.
+
+    Args:
+        older_than (int): only messages older than this many seconds,
+            the recent ones are probably still being downloaded
+        limit (int): maximum number of messages
+
+    Returns:
+        list: list of message ids
+    """
+    cursor = message_coll.find(
+        {'created_at': {'$lt': datetime.utcnow() - timedelta(seconds=older_than)},
+         'attachments': {'$elemMatch': {
+             'status': {'$in': ['pending', 'failed']},
+             'attempts': {'$not': {'$gte': MAX_DOWNLOAD_ATTEMPTS}}}}},
+        {'attachments.uid': 1, 'attachments.status': 1}
+    ).sort([('created_at', -1)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return [doc['_id'] for doc in cursor
+            if any(att.get('status') in ('pending', 'failed')
+                   and mediaworker.get_pending(att.get('uid')) is None
+                   for att in doc.get('attachments', []))]
+
+
+def load_image_index():
+    """Loads the hash of every stored image into the image hash index.
+
+    Returns:
+        int: number of indexed images
+    """
+    index = imageindex.get_index()
+    cursor = message_coll.aggregate([
+        {'$match': {'attachments.image_hash': {'$exists': True}}},
+        {'$unwind': '$attachments'},
+        {'$match': {'attachments.type': 'image',
+                    'attachments.image_hash': {'$nin': ['', None]}}},
+        {'$project': {'hash': '$attachments.image_hash', 'created_at': 1}}
+    ])
+    for doc in cursor:
+        index.add(doc['hash'], doc['_id'], doc['created_at'])
+    logger.info(f'Loaded {len(index)} images into the image hash index')
+    return len(index)
+
+
+def download_attachments(message: fbchat.Message, stored=None):
+    """Schedules the download of the media attachments of a message
+    on the background media workers. Attachments that are persisted in
+    `stored` or are being downloaded already are skipped.
+
+    Args:
+        message (fbchat.Message): message with the attachments
+        stored (dict): attachment documents already in the db by uid
+
+    Returns:
+        list: list of futures of the download jobs
+    """
+    stored = stored or {}
+    return [mediaworker.submit(att.id, download_attachment, att,
+                               message.created_at, message.id,
+                               message.author)
+            for att in message.attachments
+            if isinstance(att, MEDIA_ATTACHMENTS)
+            and not is_attachment_stored(att, stored)]
+
+
+def serialize_message(message_object, stored=None):
+    """Serializes a message to the fields of its db document.
 
     Args:
         message_object (Message): fbchat message object
+        stored (dict): attachment documents already in the db by uid
+
+    Returns:
+        dict: message fields
     """
+    return {
+        'text': message_object.text,
+        'mentions': serialize_mentions(*message_object.mentions),
+        'author': message_object.author,
+        'created_at': message_object.created_at,
+        # 'is_read': message_object.is_read,
+        # 'read_by': message_object.read_by,
+        'reactions': message_object.reactions,
+        'sticker': None,
+        'attachments': serialize_attachments(message_object, stored),
+        'replied_to': message_object.replied_to.id if message_object.replied_to else None,
+        'unsent': message_object.unsent,
+    }
+
+
+def insert_or_update_messages(messages, refresh_media=False):
+    """Upserts a batch of messages with a single unordered bulk write.
+    Messages that are already stored with all of their media only get
+    the fields updated that can change (reactions, unsent). Media of the
+    rest is handed over to the media workers after the write.
 
-    update = message_coll.update_one(
-        {'_id': message_object.id},
-        {'$set': {
-            'text': message_object.text,
-            'mentions': serialize_mentions(*message_object.mentions),
-            'author': message_object.author,
-            'created_at': message_object.created_at,
-            # 'is_read': message_object.is_read,
-            # 'read_by': message_object.read_by,
-            'reactions': message_object.reactions,
-            'sticker': None,
-            'attachments': serialize_attachments(message_object),
-            'replied_to': message_object.replied_to.id if message_object.replied_to else None,
-            'unsent': message_object.unsent,
-         }},
-        upsert=True
-    )
-    return not bool(update.matched_count)
+    Args:
+        messages (list): list of fbchat.MessageData objects
+        refresh_media (bool): download and hash every media attachment
+            again, even if they are already stored
+
+    Returns:
+        tuple: (inserted count, updated count)
+    """
+    messages = list(messages)
+    if not messages:
+        return 0, 0
+
+    stored_by_mid = {}
+    if not refresh_media:
+        cursor = message_coll.find({'_id': {'$in': [m.id for m in messages]}},
+                                   {'attachments': 1})
+        stored_by_mid = {doc['_id']: {att.get('uid'): att for att
+                                      in doc.get('attachments', [])}
+                         for doc in cursor}
+
+    operations = []
+    for msg in messages:
+        stored = stored_by_mid.get(msg.id)
+        if stored is not None and all(is_attachment_stored(att, stored)
+                                      for att in msg.attachments):
+            operations.append(pymongo.UpdateOne(
+                {'_id': msg.id},
+                {'$set': {'reactions': msg.reactions,
+                          'unsent': msg.unsent}}))
+        else:
+            operations.append(pymongo.UpdateOne(
+                {'_id': msg.id},
+                {'$set': serialize_message(msg, stored)},
+                upsert=True))
+
+    result = message_coll.bulk_write(operations, ordered=False)
+
+    for msg in messages:
+        download_attachments(msg, stored_by_mid.get(msg.id))
+
+    logger.debug(f'Bulk upserted {len(messages)} messages. '
+                 f'Inserted: {result.upserted_count}, '
+                 f'updated: {result.matched_count}')
+    return result.upserted_count, result.matched_count
+
+
+def insert_or_update_message(message_object, refresh_media=False):
+    """Adds a message the user with text and image. If the message is
+    already stored with all of its media, only the fields that can
+    change (reactions, unsent) are updated and nothing is downloaded.
+
+    Args:
+        message_object (Message): fbchat message object
+        refresh_media (bool): download and hash every media attachment
+            again, even if they are already stored
+
+    Returns:
+        bool: True if the message was inserted, False if updated
+    """
+    inserted, _ = insert_or_update_messages([message_object], refresh_media)
+    return bool(inserted)
 
 
 def mark_message_as_deleted(mid):
@@ -788,17 +1427,76 @@ def find_closest_message_to_date(date: datetime):
     if not (msg1 and msg2):
         return msg1 or msg2
     return msg1 if msg1.created_at < msg2.created_at else msg2
-  
-def get_var(name: str):
-    result = persistent.find_one({'name': name})
-    return result['value']
-  
+
+
+def get_var(name: str, default=None):
+    """Returns a persistent variable, or default if it's not set"""
+    result = persistent_coll.find_one({'name': name})
+    return result['value'] if result else default
+
+
 def set_var(name: str, value):
-    persistent.update_one({'name': name}, {'$set': {'value': value}}, upsert=True)
-    
-def decrement_counter(name:str, step: int = 1):
-    persistent.update_one({'name': name}, {'$inc': {'value': -step}})
-    
-def increment_counter(name:str, step: int = 1):
-    persistent.update_one({'name': name}, {'$inc': {'value': step}})
-    
+    persistent_coll.update_one({'name': name}, {'$set': {'value': value}}, upsert=True)
+
+
+def decrement_counter(name: str, step: int = 1):
+    persistent_coll.update_one({'name': name}, {'$inc': {'value': -step}})
+
+
+def increment_counter(name: str, step: int = 1):
+    persistent_coll.update_one({'name': name}, {'$inc': {'value': step}})
+
+
+# LINK CONVERSION CACHE
+
+def get_cached_conversion(key):
+    """Returns a cached link conversion if it's not expired yet.
+
+    Args:
+        key (str): normalized url of the track
+
+    Returns:
+        dict: the cached document, None if there is no such conversion
+    """
+    return link_cache_coll.find_one({'_id': key,
+                                     'expires_at': {'$gt': datetime.utcnow()}})
+
+
+def cache_conversion(key, result, ttl):
+    """Saves the result of a link conversion.
+
+    Args:
+        key (str): normalized url of the track
+        result (dict): the conversion result
+        ttl (int): seconds the result is valid for
+    """
+    link_cache_coll.replace_one(
+        {'_id': key},
+        {**result, 'expires_at': datetime.utcnow() + timedelta(seconds=ttl)},
+        upsert=True)
+
+
+# ARTIST GAZETTEER
+
+def get_artists():
+    """Returns every artist of the gazetteer.
+
+    Returns:
+        dict: normalized name -> name
+    """
+    return {doc['_id']: doc['name'] for doc in artist_coll.find()}
+
+
+def add_artists(artists):
+    """Adds artists to the gazetteer.
+
+    Args:
+        artists (dict): normalized name -> name
+    """
+    if not artists:
+        return
+    artist_coll.bulk_write([
+        pymongo.UpdateOne({'_id': key}, {'$setOnInsert': {'name': name}},
+                          upsert=True)
+        for key, name in artists.items()
+    ], ordered=False)
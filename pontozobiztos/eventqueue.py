@@ -0,0 +1,171 @@
+"""Bounded ingestion queue between the fbchat listener and the plugin
+workers. Every worker takes the next task from one shared queue, so a
+slow task only occupies its own worker. Tasks with the same key are run
+one after the other, in the order they were put, tasks without a key
+run in parallel:
+
+    - events are keyed by thread id, so the messages of a thread are
+      stored and dispatched in the order they arrived
+    - plugin calls are keyed by (thread id, plugin) only for plugins that
+      need to see the messages in order (ORDERED = True in the plugin,
+      e.g. counting_game), the others go to any free worker
+"""
+
+from collections import OrderedDict, deque
+import itertools
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger("chatbot")
+
+
+class EventQueue:
+    def __init__(self, handler, workers=4, maxsize=1000):
+        """
+        Args:
+            handler (callable): function called with every event
+            workers (int): number of worker threads
+            maxsize (int): maximum number of unfinished tasks. put()
+                blocks while there are more.
+        """
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.tasks = queue.Queue()
+        self.threads = []
+        # key -> tasks waiting for the running task of the same key
+        self._pending = {}
+        # task id -> time.monotonic() it was put, oldest first
+        self._waiting = OrderedDict()
+        self._ids = itertools.count()
+        self._size = 0
+        self._processed = 0
+        # put() is waiting for room, or was the last time it was called
+        self._blocked = False
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+
+    def start(self):
+        """Starts the worker threads"""
+        for i in range(self.workers):
+            self._start_worker(i)
+        logger.info(f'Started {len(self.threads)} plugin workers')
+
+    def _start_worker(self, i):
+        thread = threading.Thread(target=self._run, args=(i,),
+                                  name=f'plugin-worker-{i}', daemon=True)
+        thread.start()
+        with self._lock:
+            self.threads[i:i + 1] = [thread]
+
+    def _run(self, i):
+        try:
+            self._work()
+        finally:
+            # only SystemExit or KeyboardInterrupt get here, the pool
+            # must not shrink, put() would block the listener for good
+            logger.error(f'Plugin worker {i} stopped, starting a new one')
+            self._start_worker(i)
+
+    def put(self, event, key=None):
+        """Puts an event to the queue. Blocks if the queue is full, which
+        slows down the listener instead of growing the backlog without
+        bounds.
+
+        Args:
+            event (fbchat.Event): event to handle
+            key: events with the same key (e.g. thread id) are handled
+                in order
+        """
+        with self._not_full:
+            if self._size >= self.maxsize:
+                # logged once until the queue is half empty again, not
+                # for every event of a backlog
+                if not self._blocked:
+                    logger.warning(f'Event queue is full ({self.maxsize}). '
+                                   f'Listener is waiting for the plugins.')
+                    self._blocked = True
+                while self._size >= self.maxsize:
+                    self._not_full.wait()
+            elif self._blocked and self._size <= self.maxsize // 2:
+                logger.info('Event queue caught up')
+                self._blocked = False
+            self._add((self.handler, (event,), key))
+
+    def submit(self, func, *args, key=None):
+        """Puts a task to the queue without blocking, to be called from
+        the workers (e.g. the plugins of a handled event).
+
+        Args:
+            func (callable): function to call
+            *args: arguments of func
+            key: tasks with the same key are run in order
+        """
+        with self._lock:
+            self._add((func, args, key))
+
+    def _add(self, task):
+        """Queues a task, called with the lock held"""
+        task_id = next(self._ids)
+        self._waiting[task_id] = time.monotonic()
+        self._size += 1
+        task = (task_id, *task)
+        key = task[3]
+        if key is None:
+            self.tasks.put(task)
+        elif key in self._pending:
+            self._pending[key].append(task)
+        else:
+            self._pending[key] = deque()
+            self.tasks.put(task)
+
+    def _work(self):
+        while True:
+            task_id, func, args, key = self.tasks.get()
+            with self._lock:
+                del self._waiting[task_id]
+            try:
+                func(*args)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except BaseException as e:
+                # e.g. the plugin exceptions of link_mirror derive from
+                # BaseException, they must not kill the worker
+                logger.exception(f'Failed to handle event: {e!r}')
+            finally:
+                with self._lock:
+                    self._processed += 1
+                    self._size -= 1
+                    if key is not None:
+                        pending = self._pending[key]
+                        if pending:
+                            self.tasks.put(pending.popleft())
+                        else:
+                            del self._pending[key]
+                    self._not_full.notify()
+
+    @property
+    def depth(self):
+        """Number of tasks waiting to be run"""
+        with self._lock:
+            return len(self._waiting)
+
+    @property
+    def lag(self):
+        """Seconds the oldest waiting task has been in the queue"""
+        with self._lock:
+            if not self._waiting:
+                return 0.0
+            return time.monotonic() - next(iter(self._waiting.values()))
+
+    def get_stats(self):
+        """Returns queue statistics
+
+        Returns:
+            dict: depth, lag (seconds) and processed task count
+        """
+        return {'depth': self.depth,
+                'lag': round(self.lag, 3),
+                'processed': self._processed}
@@ -0,0 +1,103 @@
+"""Batch perceptual hashing. Every image is decoded once and all of the
+hash types are calculated from that decode. The hashes of a batch are
+calculated together with array operations.
+
+Images are decoded at full resolution, not in JPEG draft mode: the
+hashes are stored and compared with the ones already in the database,
+and a reduced scale decode changes them.
+
+Hash types (all 64 bit, hex strings like imagehash.ImageHash):
+    - phash: DCT hash, same algorithm as imagehash.phash
+    - dhash: horizontal gradient hash, same as imagehash.dhash
+    - whash: Haar wavelet hash. The low-low band of a 3 level Haar
+      decomposition of a 64x64 image compared to its median. Unlike
+      imagehash.whash the scale is fixed, so it doesn't need pywt.
+"""
+
+from PIL import Image, UnidentifiedImageError
+import logging
+
+# numpy and scipy are imported in the functions, they are slow to import
+# and most starts never hash an image
+
+log = logging.getLogger('chatbot.imagehashing')
+
+HASH_TYPES = ('phash', 'dhash', 'whash')
+HASH_SIZE = 8
+
+
+def _bits_to_hex(bits):
+    """(N, 8, 8) bool array -> list of N hex strings"""
+    import numpy
+    packed = numpy.packbits(bits.reshape(len(bits), -1), axis=1)
+    return [row.tobytes().hex() for row in packed]
+
+
+def decode(image):
+    """Decodes an image once and prepares the inputs of every hash.
+
+    Args:
+        image (str | file): path of the image or a file object
+
+    Returns:
+        tuple: (32x32, 8x9, 64x64) grayscale float arrays,
+            or None if the image can't be read
+    """
+    try:
+        img = Image.open(image).convert('L')
+    except (UnidentifiedImageError, OSError) as e:
+        log.warning(f'Could not decode image {image}: {e}')
+        return None
+    import numpy
+    size = HASH_SIZE
+    return (numpy.asarray(img.resize((size * 4, size * 4), Image.LANCZOS), dtype=float),
+            numpy.asarray(img.resize((size + 1, size), Image.LANCZOS), dtype=float),
+            numpy.asarray(img.resize((size * 8, size * 8), Image.LANCZOS), dtype=float))
+
+
+def hash_decoded(decoded):
+    """Calculates every hash type of a batch of decoded images.
+
+    Args:
+        decoded (list): list of decode() results (not None)
+
+    Returns:
+        list: list of {'phash', 'dhash', 'whash'} dicts
+    """
+    if not decoded:
+        return []
+    import numpy
+    import scipy.fftpack
+    p_pixels = numpy.stack([d[0] for d in decoded])
+    d_pixels = numpy.stack([d[1] for d in decoded])
+    w_pixels = numpy.stack([d[2] for d in decoded])
+    n, size = len(decoded), HASH_SIZE
+
+    dct = scipy.fftpack.dct(scipy.fftpack.dct(p_pixels, axis=1), axis=2)
+    low = dct[:, :size, :size]
+    phash = low > numpy.median(low.reshape(n, -1), axis=1)[:, None, None]
+
+    dhash = d_pixels[:, :, 1:] > d_pixels[:, :, :-1]
+
+    # the Haar low-low band is the mean of each 8x8 block (up to scaling)
+    ll = w_pixels.reshape(n, size, 8, size, 8).mean(axis=(2, 4))
+    whash = ll > numpy.median(ll.reshape(n, -1), axis=1)[:, None, None]
+
+    return [dict(zip(HASH_TYPES, hashes)) for hashes
+            in zip(_bits_to_hex(phash), _bits_to_hex(dhash), _bits_to_hex(whash))]
+
+
+def hash_images(images):
+    """Calculates every hash type of a batch of images.
+
+    Args:
+        images (list): paths or file objects of the images
+
+    Returns:
+        list: {'phash', 'dhash', 'whash'} dict for every image. The
+            hashes are '' for images that can't be read.
+    """
+    decoded = [decode(image) for image in images]
+    hashes = iter(hash_decoded([d for d in decoded if d is not None]))
+    return [next(hashes) if d is not None else dict.fromkeys(HASH_TYPES, '')
+            for d in decoded]
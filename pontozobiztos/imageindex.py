@@ -0,0 +1,112 @@
+"""In-memory index of perceptual image hashes for Hamming distance
+queries (multi-index hashing). The 64 bit hashes are split into
+4 chunks of 16 bits, each chunk is indexed in its own table. If two
+hashes are within distance r, at least one of their chunks differs in
+at most r // 4 bits, so a query only has to look up the variants of its
+chunks within that many bit flips and verify the candidates.
+"""
+
+from datetime import timezone
+from itertools import combinations
+import threading
+import logging
+
+log = logging.getLogger('chatbot')
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def naive_utc(date):
+    """Mongo returns naive UTC datetimes, fbchat aware ones. The index
+    keeps naive UTC, so they can be compared."""
+    if date is not None and date.tzinfo is not None:
+        return date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class ImageHashIndex:
+    def __init__(self):
+        self.tables = [{} for _ in range(CHUNKS)]
+        # hash -> list of (mid, created_at), created_at in naive UTC
+        self.entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chunks(value):
+        return [(value >> (i * CHUNK_BITS)) & CHUNK_MASK for i in range(CHUNKS)]
+
+    def add(self, image_hash, mid, created_at):
+        """Adds an image to the index.
+
+        Args:
+            image_hash (str): hex string of the hash
+            mid (str): facebook message_id of the image
+            created_at (datetime): when the message was sent (naive UTC
+                or timezone aware)
+        """
+        try:
+            value = int(image_hash, 16)
+        except (TypeError, ValueError):
+            return
+        created_at = naive_utc(created_at)
+        with self._lock:
+            if value not in self.entries:
+                self.entries[value] = []
+                for table, chunk in zip(self.tables, self._chunks(value)):
+                    table.setdefault(chunk, []).append(value)
+            if all(m != mid for m, _ in self.entries[value]):
+                self.entries[value].append((mid, created_at))
+
+    def query(self, image_hash, max_distance=0):
+        """Finds the images within max_distance of image_hash.
+
+        Args:
+            image_hash (str): hex string of the hash
+            max_distance (int): maximum Hamming distance
+
+        Returns:
+            list: list of (distance, mid, created_at) tuples
+                ordered by created_at (naive UTC)
+        """
+        try:
+            value = int(image_hash, 16)
+        except (TypeError, ValueError):
+            return []
+
+        flips = max_distance // CHUNKS
+        masks = [0]
+        for n in range(1, flips + 1):
+            masks += [sum(1 << b for b in bits)
+                      for bits in combinations(range(CHUNK_BITS), n)]
+
+        with self._lock:
+            candidates = set()
+            for table, chunk in zip(self.tables, self._chunks(value)):
+                for mask in masks:
+                    candidates.update(table.get(chunk ^ mask, ()))
+
+            result = []
+            for candidate in candidates:
+                distance = hamming_distance(value, candidate)
+                if distance <= max_distance:
+                    result += [(distance, mid, created_at) for mid, created_at
+                               in self.entries[candidate]]
+        result.sort(key=lambda x: x[2])
+        return result
+
+    def __len__(self):
+        return sum(len(v) for v in self.entries.values())
+
+
+index = ImageHashIndex()
+
+
+def get_index() -> ImageHashIndex:
+    return index
@@ -0,0 +1,81 @@
+"""Lazily created objects. Heavy clients (API clients, indexes loaded from
+the db) are created on their first use instead of at import, so the bot
+can start listening quickly. Every lazy object is registered for the
+optional background warm-up, which creates them after the bot started
+listening, before the first message needs them.
+
+    ytmusic = lazy.LazyObject(create_ytmusic, 'YTMusic client')
+    ytmusic.search(...)  # created on the first attribute access
+"""
+
+from pontozobiztos import startup_profiler
+import threading
+import logging
+
+logger = logging.getLogger("chatbot")
+
+_warm_ups = []  # (name, callable)
+
+
+def register_warm_up(name, func):
+    """Registers func to be called by the background warm-up"""
+    _warm_ups.append((name, func))
+
+
+class LazyObject:
+    """Proxy of an object that's created by factory on first use"""
+
+    def __init__(self, factory, name, warm_up=True):
+        """
+        Args:
+            factory (callable): creates the object, called only once
+            name (str): name used in the logs and the startup profile
+            warm_up (bool): create it in the background warm-up
+        """
+        self._factory = factory
+        self._name = name
+        self._obj = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        if warm_up:
+            register_warm_up(name, self.get)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        """Returns the object, creates it if needed"""
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    with startup_profiler.measure('load ' + self._name):
+                        self._obj = self._factory()
+                    self._loaded = True
+                    logger.info(f'Loaded {self._name}')
+        return self._obj
+
+    def __getattr__(self, item):
+        return getattr(self.get(), item)
+
+    def __repr__(self):
+        state = 'loaded' if self._loaded else 'not loaded'
+        return f'<LazyObject {self._name} ({state})>'
+
+
+def warm_up():
+    """Creates every registered lazy object. Failures are logged, the
+    object will be created again on its first use."""
+    for name, func in list(_warm_ups):
+        try:
+            func()
+        except Exception as e:
+            logger.warning(f'Warm-up of {name} failed: {e}')
+    logger.info('Warm-up finished')
+
+
+def start_warm_up():
+    """Runs warm_up on a background daemon thread"""
+    thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,454 @@
+"""Content-addressed media store. Every file is stored once under the
+SHA-256 digest of its content, with a two level sharded key:
+
+    ab/cd/abcd...ef.jpg
+
+Reposted images end up in the same blob. The per-attachment metadata
+(message, author, date) is kept in the messages collection, which refers
+to the blobs by their path (see MediaBackend.uri).
+
+The blobs are kept by a pluggable backend selected with MEDIA_BACKEND:
+    - filesystem (default): files below MEDIA_DIRECTORY
+    - gridfs: GridFS bucket in the chat database, so the bot, the webapp
+      and backfill workers don't have to share a volume
+
+Every read and write is chunked, files are never loaded into memory
+as a whole.
+"""
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger("chatbot")
+
+MEDIA_BACKEND = os.getenv('MEDIA_BACKEND', 'filesystem')
+MEDIA_DIRECTORY = pathlib.Path(os.getenv('MEDIA_DIRECTORY', '/chatbot_data/media/'))
+GRIDFS_BUCKET = 'media'
+CHUNK_SIZE = 64 * 1024
+# temp blobs older than this are left over by crashed processes
+TEMP_MAX_AGE = 24 * 60 * 60  # seconds
+
+
+class MediaBackend(ABC):
+    """Interface of the media storage backends. Blobs are identified by
+    their key inside the backend, and by their uri (stored as 'path')
+    everywhere else."""
+
+    @abstractmethod
+    def create_temp(self):
+        """Returns a writer for new content. Its key is only known after
+        the content is written, see TempBlob."""
+
+    @abstractmethod
+    def cleanup_temp(self, max_age):
+        """Removes the temp blobs older than max_age seconds, left over
+        by processes that crashed while writing them. Returns the number
+        of removed blobs."""
+
+    @abstractmethod
+    def exists(self, key) -> bool:
+        pass
+
+    @abstractmethod
+    def open(self, key):
+        """Returns a readable, seekable file object of the blob"""
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    @abstractmethod
+    def uri(self, key) -> str:
+        """Returns the path the blob is referred to by the messages"""
+
+    @abstractmethod
+    def key_of(self, uri):
+        """Returns the key of a blob uri, None if the uri doesn't
+        belong to this backend"""
+
+
+class TempBlob(ABC):
+    """Content being written to a backend before its key is known"""
+
+    @abstractmethod
+    def write(self, data):
+        pass
+
+    @abstractmethod
+    def finalize(self, key) -> bool:
+        """Stores the content under key. Returns True if the key existed
+        already and the content was dropped."""
+
+    @abstractmethod
+    def discard(self):
+        pass
+
+
+class FilesystemBackend(MediaBackend):
+    def __init__(self, root):
+        self.root = pathlib.Path(root)
+        self.tmp_dir = self.root / 'tmp'
+
+    def create_temp(self):
+        return FilesystemTempBlob(self)
+
+    def cleanup_temp(self, max_age):
+        if not self.tmp_dir.is_dir():
+            return 0
+        removed = 0
+        oldest = time.time() - max_age
+        for path in self.tmp_dir.iterdir():
+            try:
+                if path.stat().st_mtime < oldest:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def _path(self, key):
+        return self.root / key
+
+    def exists(self, key):
+        return self._path(key).is_file()
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def delete(self, key):
+        os.remove(self._path(key))
+
+    def uri(self, key):
+        return str(self._path(key))
+
+    def key_of(self, uri):
+        try:
+            return pathlib.Path(uri).relative_to(self.root).as_posix()
+        except ValueError:
+            return None
+
+
+class FilesystemTempBlob(TempBlob):
+    def __init__(self, backend: FilesystemBackend):
+        self.backend = backend
+        backend.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._tmp = tempfile.NamedTemporaryFile(dir=backend.tmp_dir, delete=False)
+
+    def write(self, data):
+        return self._tmp.write(data)
+
+    def finalize(self, key):
+        self._tmp.close()
+        path = self.backend._path(key)
+        if path.exists():
+            os.remove(self._tmp.name)
+            return True
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(self._tmp.name, 0o644)  # temp files are private by default
+        os.replace(self._tmp.name, path)
+        return False
+
+    def discard(self):
+        self._tmp.close()
+        os.remove(self._tmp.name)
+
+
+class GridFSBackend(MediaBackend):
+    URI_PREFIX = 'gridfs://'
+    # filename prefix of the temp uploads, the keys are sharded digests
+    TEMP_PREFIX = 'tmp/'
+
+    def __init__(self, bucket_name=GRIDFS_BUCKET):
+        self.bucket_name = bucket_name
+        self._pid = None
+
+    def _connect(self):
+        # MongoClient is not fork-safe, worker processes (e.g. the hash
+        # backfill) have to open their own connection
+        import gridfs
+        import pymongo
+        client = pymongo.MongoClient(host=os.getenv('MONGO_HOST'),
+                                     port=int(os.getenv('MONGO_PORT')))
+        self._bucket = gridfs.GridFSBucket(client.chat, bucket_name=self.bucket_name,
+                                           chunk_size_bytes=CHUNK_SIZE * 4)
+        self._files = client.chat[self.bucket_name + '.files']
+        self._pid = os.getpid()
+
+    @property
+    def bucket(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._bucket
+
+    @property
+    def files(self):
+        if self._pid != os.getpid():
+            self._connect()
+        return self._files
+
+    def create_temp(self):
+        return GridFSTempBlob(self)
+
+    def cleanup_temp(self, max_age):
+        from bson import ObjectId
+        oldest = datetime.utcnow() - timedelta(seconds=max_age)
+        removed = 0
+        # closed uploads that were not renamed
+        for doc in self.files.find({'filename': {'$regex': '^' + self.TEMP_PREFIX},
+                                    'uploadDate': {'$lt': oldest}}, {'_id': 1}):
+            self.bucket.delete(doc['_id'])
+            removed += 1
+
+        # uploads that were not closed have chunks but no file document.
+        # Only the chunks since the last cleanup are checked, the ids of
+        # the uploads are ObjectIds in the order they were started.
+        chunks = self.files.database[self.bucket_name + '.chunks']
+        state = self.files.database[self.bucket_name + '.cleanup']
+        checkpoint = state.find_one({'_id': 'temp'}) or {}
+        until = ObjectId.from_datetime(oldest)
+        query = {'files_id': {'$lt': until}, 'n': 0}
+        if 'until' in checkpoint:
+            query['files_id']['$gte'] = checkpoint['until']
+        file_ids = [c['files_id'] for c in chunks.find(query, {'files_id': 1})]
+        stored = {f['_id'] for f in self.files.find({'_id': {'$in': file_ids}},
+                                                    {'_id': 1})}
+        for file_id in file_ids:
+            if file_id not in stored:
+                chunks.delete_many({'files_id': file_id})
+                removed += 1
+        state.update_one({'_id': 'temp'}, {'$set': {'until': until}}, upsert=True)
+        return removed
+
+    def _file_id(self, key):
+        doc = self.files.find_one({'filename': key}, {'_id': 1})
+        return doc['_id'] if doc else None
+
+    def exists(self, key):
+        return self._file_id(key) is not None
+
+    def open(self, key):
+        return self.bucket.open_download_stream_by_name(key)
+
+    def delete(self, key):
+        file_id = self._file_id(key)
+        if file_id is not None:
+            self.bucket.delete(file_id)
+
+    def uri(self, key):
+        return self.URI_PREFIX + key
+
+    def key_of(self, uri):
+        if not uri.startswith(self.URI_PREFIX):
+            return None
+        return uri[len(self.URI_PREFIX):]
+
+
+class GridFSTempBlob(TempBlob):
+    def __init__(self, backend: GridFSBackend):
+        self.backend = backend
+        # unique name, so the uploads of crashed processes can be found
+        self._upload = backend.bucket.open_upload_stream(
+            backend.TEMP_PREFIX + uuid.uuid4().hex)
+
+    def write(self, data):
+        self._upload.write(data)
+        return len(data)
+
+    def finalize(self, key):
+        self._upload.close()
+        if self.backend.exists(key):
+            self.backend.bucket.delete(self._upload._id)
+            return True
+        self.backend.bucket.rename(self._upload._id, key)
+        return False
+
+    def discard(self):
+        self._upload.abort()
+
+
+def create_backend(name=MEDIA_BACKEND) -> MediaBackend:
+    if name == 'filesystem':
+        return FilesystemBackend(MEDIA_DIRECTORY)
+    if name == 'gridfs':
+        return GridFSBackend()
+    raise ValueError(f'Unknown media backend: {name}')
+
+
+backend = create_backend()
+
+
+def get_backend() -> MediaBackend:
+    return backend
+
+
+def cleanup_temp(max_age=TEMP_MAX_AGE):
+    """Removes the temp blobs left over by crashed processes. Only the
+    old ones, other processes might be writing the recent ones.
+
+    Args:
+        max_age (int): seconds after a temp blob counts as left over
+
+    Returns:
+        int: number of removed blobs
+    """
+    removed = backend.cleanup_temp(max_age)
+    if removed:
+        logger.info(f'Removed {removed} left over temp blobs')
+    return removed
+
+
+def blob_key(digest, extension):
+    """Returns the key of a blob in the store.
+
+    Args:
+        digest (str): hex SHA-256 digest of the content
+        extension (str): file extension without the dot
+
+    Returns:
+        str: key of the blob
+    """
+    return f'{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+
+def digest_of(path):
+    """Returns the digest of a blob from its path"""
+    return pathlib.PurePosixPath(path).stem
+
+
+def is_stored(path):
+    """Returns True if the path refers to a blob of the store"""
+    return backend.key_of(path) is not None
+
+
+def exists(path):
+    """Checks whether a media file exists. Paths outside of the store
+    (old flat directories) are checked on the local filesystem.
+
+    Args:
+        path (str): path of the media file
+
+    Returns:
+        bool: True if it exists
+    """
+    key = backend.key_of(path)
+    if key is None:
+        return os.path.isfile(path)
+    return backend.exists(key)
+
+
+def open_blob(path):
+    """Opens a media file for reading. Paths outside of the store
+    (old flat directories) are opened from the local filesystem.
+
+    Args:
+        path (str): path of the media file
+
+    Returns:
+        file object: readable, seekable file object
+    """
+    key = backend.key_of(path)
+    if key is None:
+        return open(path, 'rb')
+    return backend.open(key)
+
+
+def iter_blob(path, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Streams a media file, or a byte range of it, in chunks.
+
+    Args:
+        path (str): path of the media file
+        start (int): first byte to read
+        end (int): byte to stop before (default: end of the file)
+        chunk_size (int): maximum size of the chunks
+
+    Yields:
+        bytes: the next chunk
+    """
+    with open_blob(path) as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+class BlobWriter:
+    """File-like object that stores the written content in the media
+    store. The content is written to the backend and hashed at the same
+    time; on close it's stored under its digest, or dropped if the same
+    content is stored already.
+
+        with BlobWriter('jpg') as blob:
+            blob.write(data)
+        blob.path, blob.digest
+    """
+
+    def __init__(self, extension):
+        self.extension = extension
+        self.digest = None
+        self.path = None
+        self.deduplicated = False
+        self._hash = hashlib.sha256()
+        self._tmp = backend.create_temp()
+
+    def write(self, data):
+        self._hash.update(data)
+        return self._tmp.write(data)
+
+    def commit(self):
+        """Stores the content under its digest"""
+        self.digest = self._hash.hexdigest()
+        key = blob_key(self.digest, self.extension)
+        self.deduplicated = self._tmp.finalize(key)
+        self.path = backend.uri(key)
+        if self.deduplicated:
+            logger.debug(f'Blob {self.digest} is already stored')
+
+    def abort(self):
+        """Drops the written content"""
+        self._tmp.discard()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
+
+
+def store_file(path, extension=None, move=False):
+    """Stores an existing local file in the media store.
+
+    Args:
+        path (str): path of the file
+        extension (str): extension of the blob (default: from path)
+        move (bool): remove the original file after storing it
+
+    Returns:
+        BlobWriter: the committed blob (path, digest, deduplicated)
+    """
+    extension = extension or pathlib.Path(path).suffix.lstrip('.')
+    with open(path, 'rb') as f, BlobWriter(extension) as blob:
+        shutil.copyfileobj(f, blob, CHUNK_SIZE)
+    if move:
+        os.remove(path)
+    return blob
@@ -0,0 +1,116 @@
+"""Background media downloads. Attachments are downloaded by a pool of
+worker threads over a shared, pooled HTTP session with retries, so the
+listener path only has to write the message document.
+"""
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import threading
+import io
+import logging
+import os
+
+logger = logging.getLogger("chatbot")
+
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', 4))
+TIMEOUT = 10  # seconds
+CHUNK_SIZE = 64 * 1024
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=MEDIA_WORKERS,
+    pool_maxsize=MEDIA_WORKERS,
+    max_retries=Retry(total=3, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504))))
+
+executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS,
+                              thread_name_prefix='media-worker')
+_pending = {}
+_lock = threading.Lock()
+
+
+def download(url, *sinks):
+    """Downloads url in chunks using the pooled session and writes every
+    chunk to each of the sinks.
+
+    Args:
+        url (str): url of the media
+        sinks (io.RawIOBase): file objects receiving the content, e.g.
+            a media store blob and a BytesIO for hashing the content
+            without reading the file back
+    """
+    with session.get(url, timeout=TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            for sink in sinks:
+                sink.write(chunk)
+
+
+def fetch(url):
+    """Downloads url into memory using the pooled session.
+
+    Args:
+        url (str): url of the media
+
+    Returns:
+        io.BytesIO: the content, rewound to the start
+    """
+    buffer = io.BytesIO()
+    with session.get(url, timeout=TIMEOUT, stream=True) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            buffer.write(chunk)
+    buffer.seek(0)
+    return buffer
+
+
+def submit(uid, func, *args, **kwargs) -> Future:
+    """Schedules func on the download workers. The future is available
+    with get_pending(uid) until the job is finished.
+
+    Args:
+        uid (str): attachment id the job belongs to
+        func (callable): the job
+
+    Returns:
+        Future: future of the job
+    """
+    future = executor.submit(func, *args, **kwargs)
+    with _lock:
+        _pending[uid] = future
+
+    def done(fut):
+        with _lock:
+            if _pending.get(uid) is fut:
+                del _pending[uid]
+        if fut.exception() is not None:
+            logger.error(f'Media job for attachment {uid} failed: '
+                         f'{fut.exception()}')
+
+    future.add_done_callback(done)
+    return future
+
+
+def get_pending(uid):
+    """Returns the future of a pending download job or None if there
+    is no such job.
+
+    Args:
+        uid (str): attachment id
+
+    Returns:
+        Future: future of the job, or None
+    """
+    with _lock:
+        return _pending.get(uid)
+
+
+def pending_count():
+    """Number of unfinished media jobs"""
+    with _lock:
+        return len(_pending)
@@ -1,5 +1,3 @@
-from functools import reduce
-import operator
 from datetime import datetime
 
 from pontozobiztos import chatmongo
@@ -8,10 +6,6 @@ from pontozobiztos.models import Point
 from pontozobiztos.models import Multiplier
 
 
-# TODO: This should be turned into a cache if performance issues arise.
-# consider using the signal library, to signal changes back from the
-# chatmongo module.
-
 class User:
     def __new__(cls, userid, *args, **kwargs):
         if chatmongo.get_user_info(userid):
@@ -21,9 +15,19 @@ class User:
 
     def __init__(self, userid):
         self.uid = userid
-        if not chatmongo.get_user(userid):
+        if not chatmongo.get_user_info(userid):
             raise ValueError(f'User id: {userid} is not found in db')
 
+    @staticmethod
+    def preload(*user_ids):
+        """Loads the information of many users into the user cache with
+        a single query.
+
+        Args:
+            user_ids (str): facebook user_ids
+        """
+        chatmongo.get_users_info(*user_ids)
+
     def __repr__(self):
         attr_dict = {
             "fullname": self.fullname,
@@ -79,11 +83,7 @@ class User:
     @property
     def multiplier(self):
         """Current multiplier"""
-        try:
-            return reduce(operator.mul, [mul.value for mul
-                                         in self.get_multiplier_list()])
-        except TypeError:
-            return 1.0
+        return chatmongo.get_multiplier(self.uid)
 
     def set_multiplier(self, value, typename, days=0, hours=0, minutes=0):
         """Sets a multiplier for the current user until the given time.
@@ -0,0 +1,65 @@
+"""In-memory index of the active multipliers of a user. The product of
+the multipliers is cached and only recalculated when a multiplier is
+set or the earliest one expires.
+"""
+
+from datetime import datetime
+import bisect
+import threading
+
+
+class MultiplierIndex:
+    def __init__(self, multipliers=()):
+        """
+        Args:
+            multipliers (list): multiplier documents with typename, value
+                and expiration_date fields. Expired ones are dropped.
+        """
+        now = datetime.now()
+        # (expiration_date, typename, value) ordered by expiration_date
+        self.entries = sorted((m['expiration_date'], m['typename'], m['value'])
+                              for m in multipliers
+                              if m['expiration_date'] >= now)
+        self._product = None
+        self._lock = threading.Lock()
+
+    def set(self, typename, value, expiration_date):
+        """Adds a new multiplier or replaces the one with the same
+        typename.
+
+        Args:
+            typename (str): type of the multiplier
+            value (float): multiplication factor
+            expiration_date (datetime): expiration date of the multiplier
+        """
+        with self._lock:
+            self.entries = [e for e in self.entries if e[1] != typename]
+            bisect.insort(self.entries, (expiration_date, typename, value))
+            self._product = None
+
+    def product(self, now=None):
+        """Returns the product of the active multipliers.
+
+        Args:
+            now (datetime): time to check the expiration against
+
+        Returns:
+            float: product of the multipliers (1.0 if there is none)
+        """
+        now = now or datetime.now()
+        with self._lock:
+            expired = 0
+            while expired < len(self.entries) and self.entries[expired][0] < now:
+                expired += 1
+            if expired:
+                del self.entries[:expired]
+                self._product = None
+
+            if self._product is None:
+                self._product = 1.0
+                for _, _, value in self.entries:
+                    self._product *= value
+            return self._product
+
+    def __len__(self):
+        return len(self.entries)
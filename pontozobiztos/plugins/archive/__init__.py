@@ -1,5 +1,7 @@
 from datetime import datetime
-from pontozobiztos import chatmongo
+from pontozobiztos import chatmongo, triggers
+
+TRIGGERS = [triggers.command('shortcut')]
 
 
 def on_message(message, author):
@@ -1,3 +1,8 @@
 from . import counting_app
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.ALWAYS]
+# the numbers have to be checked in the order they were sent
+ORDERED = True
 
 on_message = counting_app.on_message
\ No newline at end of file
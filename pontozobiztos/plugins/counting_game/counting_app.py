@@ -1,10 +1,11 @@
-from num2words import num2words
 from unidecode import unidecode
-from fuzzywuzzy import fuzz
 from fbchat import Message
 from pontozobiztos import chatmongo
 from pontozobiztos import utils
 from pontozobiztos import chatscheduler
+from pontozobiztos import lazy
+from .number_matcher import NumberMatcher
+from .vocabulary import NumberVocabulary
 import fbchat
 from datetime import datetime
 from datetime import timedelta
@@ -24,17 +25,15 @@ current_thread: fbchat.GroupData
 game_over_job = None
 
 accepted_languages = ['hu', 'en', 'fr', 'it', 'de']
-numbers_0_to_500 = {}
-for n in range(500):
-    numbers_0_to_500.update({unidecode(num2words(n, lang=l)): n
-                             for l in accepted_languages})
+number_matcher = NumberMatcher(FUZZY_LIMIT)
+vocabulary = NumberVocabulary(number_matcher, accepted_languages)
+lazy.register_warm_up('counting_game number words',
+                      lambda: vocabulary.ensure(expected_number))
 
 
 def fuzzy_compare_to_all(text):
-    for k in numbers_0_to_500.keys():
-        if fuzz.ratio(k, text) > FUZZY_LIMIT:
-            return numbers_0_to_500[k] == expected_number
-    return None
+    vocabulary.ensure(expected_number)
+    return number_matcher.match(text, expected_number)
 
 
 def format_scores(reason="GAME OVER"):
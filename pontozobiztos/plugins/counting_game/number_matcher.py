@@ -0,0 +1,218 @@
+"""Matches messages against spelled-out numbers. The steps, cheapest
+first:
+
+    1. exact lookup of the normalized text
+    2. fuzzy comparison with the spellings of the expected number and its
+       neighbours only (the usual case during a game)
+    3. BK-tree search in the whole vocabulary within the edit distance
+       that fuzz.ratio > limit allows, verified with fuzz.ratio. There is
+       a tree for every word length, only the lengths within that edit
+       distance are searched. Texts that don't share enough bigrams with
+       any of the words (most chat messages) skip the trees.
+
+The best scoring spelling wins, not the first one above the limit.
+"""
+
+from fuzzywuzzy import fuzz
+import threading
+
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+
+def bigrams(text):
+    return [text[i:i + 2] for i in range(len(text) - 1)]
+
+
+def levenshtein(a, b):
+    # common prefix and suffix don't change the distance
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    a, b = a[start:], b[start:]
+    while a and b and a[-1] == b[-1]:
+        a, b = a[:-1], b[:-1]
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """Burkhard-Keller tree of words for edit distance queries"""
+
+    def __init__(self, words=()):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node = self.root
+        while True:
+            distance = levenshtein(word, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (word, {})
+                return
+            node = child
+
+    def query(self, word, max_distance):
+        """Returns the words within max_distance of word.
+
+        Args:
+            word (str): the word to search for
+            max_distance (int): maximum Levenshtein distance
+
+        Returns:
+            list: list of (distance, word) tuples
+        """
+        if self.root is None:
+            return []
+        result = []
+        stack = [self.root]
+        while stack:
+            node_word, children = stack.pop()
+            distance = levenshtein(word, node_word)
+            if distance <= max_distance:
+                result.append((distance, node_word))
+            for d in range(distance - max_distance, distance + max_distance + 1):
+                child = children.get(d)
+                if child is not None:
+                    stack.append(child)
+        return result
+
+
+class NumberMatcher:
+    def __init__(self, limit, neighbours=1):
+        """
+        Args:
+            limit (int): fuzz.ratio has to be greater than this
+            neighbours (int): numbers this close to the expected one are
+                compared directly, before searching the whole vocabulary
+        """
+        self.limit = limit
+        self.neighbours = neighbours
+        # spelling -> set of numbers (the same word can mean different
+        # numbers in different languages)
+        self.words = {}
+        # number -> list of spellings
+        self.spellings = {}
+        # bigram -> set of spellings containing it
+        self.bigrams = {}
+        # word length -> BKTree, built when that length is first searched
+        self._trees = {}
+        # words are added by the warm-up thread while the game matches
+        self._lock = threading.RLock()
+
+    def add(self, number, spelling):
+        spelling = normalize(spelling)
+        with self._lock:
+            self.words.setdefault(spelling, set()).add(number)
+            spellings = self.spellings.setdefault(number, [])
+            if spelling not in spellings:
+                spellings.append(spelling)
+            for bigram in bigrams(spelling):
+                self.bigrams.setdefault(bigram, set()).add(spelling)
+            tree = self._trees.get(len(spelling))
+            if tree is not None:
+                tree.add(spelling)
+
+    def _get_tree(self, length):
+        with self._lock:
+            tree = self._trees.get(length)
+            if tree is None:
+                tree = BKTree(w for w in self.words if len(w) == length)
+                self._trees[length] = tree
+            return tree
+
+    def _has_bigram_candidate(self, text, max_distance):
+        """Every edit removes at most 2 bigrams, so a word within
+        max_distance shares at least len(text) - 1 - 2 * max_distance
+        bigram occurrences with text."""
+        text_bigrams = bigrams(text)
+        distinct = set(text_bigrams)
+        needed = (len(text_bigrams) - 2 * max_distance
+                  - (len(text_bigrams) - len(distinct)))
+        if needed <= 0:
+            return True
+        shared = {}
+        for bigram in distinct:
+            for word in self.bigrams.get(bigram, ()):
+                shared[word] = shared.get(word, 0) + 1
+                if shared[word] >= needed:
+                    return True
+        return False
+
+    def search(self, text, max_distance):
+        """Returns the words of the vocabulary within max_distance
+        of text."""
+        with self._lock:
+            if not self._has_bigram_candidate(text, max_distance):
+                return []
+            found = []
+            for length in range(max(1, len(text) - max_distance),
+                                len(text) + max_distance + 1):
+                found += [word for _, word
+                          in self._get_tree(length).query(text, max_distance)]
+            return found
+
+    def max_distance(self, text):
+        """Upper bound of the edit distance between text and a word with
+        fuzz.ratio(text, word) > limit. The ratio is at most
+        1 - indel / (len(text) + len(word)), and the Levenshtein distance
+        is at most the indel distance."""
+        return (100 - self.limit) * 2 * len(text) // self.limit
+
+    def _best(self, text, spellings):
+        best, best_ratio = None, self.limit
+        for spelling in spellings:
+            ratio = fuzz.ratio(spelling, text)
+            if ratio > best_ratio:
+                best, best_ratio = spelling, ratio
+        return best
+
+    def match(self, text, expected):
+        """Checks whether text is the spelling of the expected number.
+
+        Args:
+            text (str): text of the message (unidecoded)
+            expected (int): the number that comes next
+
+        Returns:
+            bool: True if text is the expected number, False if it's
+                another number, None if it's not a number
+        """
+        text = normalize(text)
+        if not text:
+            return None
+        with self._lock:
+            if text in self.words:
+                return expected in self.words[text]
+
+            max_distance = self.max_distance(text)
+
+            def close(spelling):
+                return abs(len(spelling) - len(text)) <= max_distance
+
+            candidates = [s for n in range(expected - self.neighbours,
+                                           expected + self.neighbours + 1)
+                          for s in self.spellings.get(n, ()) if close(s)]
+            best = self._best(text, candidates)
+            if best is None:
+                best = self._best(text, self.search(text, max_distance))
+            if best is None:
+                return None
+            return expected in self.words[best]
@@ -0,0 +1,105 @@
+"""Spelled-out numbers of the accepted languages, provided lazily.
+
+The spellings of the first MIN_SIZE numbers are generated on first use,
+the rest in chunks when a game gets close to the end of the generated
+range (LOOKAHEAD), so wrong numbers are recognized too. They are saved to
+NUMBER_WORDS_FILE. Later starts load the saved table with one read
+instead of calling num2words again. Nothing is loaded at import.
+"""
+
+from dotenv import load_dotenv
+load_dotenv()
+
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger("chatbot")
+
+NUMBER_WORDS_FILE = os.getenv('NUMBER_WORDS_FILE',
+                              '/chatbot_data/number_words.json')
+CHUNK = 100  # numbers generated at once
+# numbers always known, so a wrong number ends the game like it did
+# with the old fixed table
+MIN_SIZE = 500
+LOOKAHEAD = 100  # numbers kept generated ahead of the game
+
+
+class NumberVocabulary:
+    def __init__(self, matcher, languages, path=NUMBER_WORDS_FILE):
+        """
+        Args:
+            matcher (NumberMatcher): receives the spellings
+            languages (list): num2words language codes
+            path (str): file the table is saved to
+        """
+        self.matcher = matcher
+        self.languages = list(languages)
+        self.path = path
+        # language -> list of spellings, index is the number
+        self.table = None
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Numbers from 0 to size - 1 are known by the matcher"""
+        if self.table is None:
+            return 0
+        return min(len(self.table.get(l, ())) for l in self.languages)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                table = json.load(f)
+        except FileNotFoundError:
+            table = {}
+        except (OSError, ValueError) as e:
+            logger.warning(f'Could not load number words from {self.path}: {e}')
+            table = {}
+        self.table = {l: table.get(l, []) for l in self.languages}
+        for l in self.languages:
+            for n, spelling in enumerate(self.table[l][:self.size]):
+                self.matcher.add(n, spelling)
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(self.table, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning(f'Could not save number words to {self.path}: {e}')
+
+    def _generate(self, stop):
+        # imported here, these are only needed for numbers that are
+        # not in the saved table
+        from num2words import num2words
+        from unidecode import unidecode
+
+        start = self.size
+        for l in self.languages:
+            del self.table[l][start:]
+            for n in range(start, stop):
+                spelling = unidecode(num2words(n, lang=l))
+                self.table[l].append(spelling)
+                self.matcher.add(n, spelling)
+        logger.info(f'Generated number words {start}-{stop - 1}')
+
+    def ensure(self, number):
+        """Makes sure the spellings of the numbers up to number
+        (and LOOKAHEAD more, at least MIN_SIZE) are known by the matcher.
+
+        Args:
+            number (int): the number the game is at
+        """
+        needed = max(number + LOOKAHEAD, MIN_SIZE - 1)
+        # size is only read under the lock, _generate changes the table
+        with self._lock:
+            if self.table is None:
+                self._load()
+            if needed < self.size:
+                return
+            stop = (needed // CHUNK + 1) * CHUNK
+            self._generate(stop)
+            self._save()
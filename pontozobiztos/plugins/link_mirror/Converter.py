@@ -1,9 +1,11 @@
 from typing import Union, Tuple, List, TypedDict
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-
-import ytmusicapi
+from pontozobiztos import lazy, urlmetadata
+from pontozobiztos.plugins.link_mirror import artist_gazetteer, conversion_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import concurrent.futures
 from unidecode import unidecode
+import threading
 import re
 import time
 import requests
@@ -16,10 +18,107 @@ import logging
 log = logging.getLogger('chatbot.link_mirror')
 
 
-spotify = spotipy.Spotify(
-    client_credentials_manager=SpotifyClientCredentials())
+def create_spotify():
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+    return spotipy.Spotify(
+        client_credentials_manager=SpotifyClientCredentials())
+
+
+# the client is created on first use, see pontozobiztos.lazy. The YTMusic
+# client is shared with the other plugins, see pontozobiztos.urlmetadata
+spotify = lazy.LazyObject(create_spotify, 'Spotify client')
+
+CONVERSION_TIMEOUT = 15  # seconds, deadline of a whole conversion
+TRACK_CACHE_SIZE = 64
+
+MAX_SEARCH_CALLS = 6  # spotify searches of one track
+
+# independent lookups of a conversion run on this pool
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='converter')
+# the searches have their own pool, they are started from the lookups
+search_executor = ThreadPoolExecutor(max_workers=MAX_SEARCH_CALLS,
+                                     thread_name_prefix='spotify-search')
+
+# spotify track id -> track object returned by search or track, so the
+# album cover and preview don't have to be fetched again
+_tracks = OrderedDict()
+_tracks_lock = threading.Lock()
+
+
+def remaining_time(deadline):
+    """Seconds left until deadline (time.monotonic), None if there
+    is no deadline"""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def run_concurrently(*calls, deadline=None):
+    """Runs the calls on the converter pool and waits for all of them.
+
+    Args:
+        calls (tuple): (func, *args) tuples
+        deadline (float): time.monotonic() by which every call has to
+            finish
+
+    Returns:
+        list: results in the order of the calls. The exception of the
+            first failed call (in call order) is raised.
+    """
+    futures = [executor.submit(func, *args) for func, *args in calls]
+    try:
+        return [f.result(timeout=remaining_time(deadline)) for f in futures]
+    except concurrent.futures.TimeoutError:
+        # drops the calls that haven't started, the running ones keep
+        # their worker until they finish
+        for f in futures:
+            f.cancel()
+        raise ConversionTimeout('Conversion timed out')
+
+
+def spotify_track_id(uri):
+    if match := re.search(r'open\.spotify\.com/(?:intl-\w+/)?track/(\w+)', uri):
+        return match.group(1)
+    return None
+
+
+def remember_track(track):
+    """Saves a spotify track object for get_track, and its artists
+    to the artist gazetteer (only in memory, see artist_gazetteer)"""
+    artist_gazetteer.add_track(track)
+    with _tracks_lock:
+        _tracks[track['id']] = track
+        _tracks.move_to_end(track['id'])
+        while len(_tracks) > TRACK_CACHE_SIZE:
+            _tracks.popitem(last=False)
+
+
+def get_track(uri):
+    """Returns the spotify track object of uri. Tracks already returned
+    by an earlier search or lookup are not fetched again."""
+    track_id = spotify_track_id(uri)
+    with _tracks_lock:
+        if track_id in _tracks:
+            return _tracks[track_id]
+    track = call_with_retires(spotify.track, uri)
+    if track:
+        remember_track(track)
+    return track
+
+
+def search_artists(name):
+    """Returns the names of the artists spotify finds for name"""
+    result = call_with_retires(spotify.search, q=name, type='artist')
+    if not result:
+        return []
+    return [it['name'] for it in result['artists']['items']]
+
 
-ytmusic = ytmusicapi.YTMusic()
+def is_artist(name):
+    """Checks name in the artist gazetteer, only unknown names are
+    searched on spotify"""
+    return artist_gazetteer.get_gazetteer().is_artist(name, search_artists)
 
 
 def call_with_retires(func, *args, **kwargs):
@@ -172,22 +271,18 @@ class ConverterBase:
         if artists.original:
             og_artist_list = split_at_delimeters(artists.original[0])
             for artist in [x for x in og_artist_list if x]:
-                spoti_search_result = call_with_retires(spotify.search, q=artist, type='artist')
-                for it in spoti_search_result['artists']['items']:
-                    if it['name'].lower() == artist:
-                        artists.original = og_artist_list
-                        break
+                if is_artist(artist):
+                    artists.original = og_artist_list
+                    break
         else:
             # this case assumes title - artist format
             og_artist_list = split_at_delimeters(final_title)
             for artist in [x for x in og_artist_list if x]:
-                spoti_search_result = call_with_retires(spotify.search, q=artist, type='artist')
-                for it in spoti_search_result['artists']['items']:
-                    if it['name'].lower() == artist:
-                        tmp = artists.original
-                        artists.original = [final_title]
-                        final_title = " ".join(tmp)
-                        break
+                if is_artist(artist):
+                    tmp = artists.original
+                    artists.original = [final_title]
+                    final_title = " ".join(tmp)
+                    break
 
         artists.remove_the_a_an()
         return final_title, artists
@@ -213,7 +308,7 @@ class ConverterBase:
         raise NotImplemented
 
     @classmethod
-    def convert(cls, uri: str) -> [str]:
+    def convert(cls, uri: str, deadline: float = None) -> [str]:
         raise NotImplemented
 
 
@@ -230,23 +325,18 @@ class Youtube(ConverterBase):
 
     @classmethod
     def get_title_and_artists(cls, uri) -> Tuple[str, List[str]]:
-        if match := re.match(cls.URI_BASE + r'/watch\?v=([^&]*)',
-                             uri):
-            track_id = match.group(1)
-        elif match := re.match('https://youtu.be/([^&]*)', uri):
-            track_id = match.group(1)
-        else:
+        if not (track_id := urlmetadata.youtube_video_id(uri)):
             raise PluginException('Invalid YouTube url')
         try:
-            res = ytmusic.get_song(track_id)
+            res = urlmetadata.get_song(track_id)
         except KeyError:
             raise PluginException('Video Unavailable')
         try:
             if res['category'] not in ('Music', 'Entertainment'):
-                raise PluginException('Not a music video')
+                raise NotMusicException('Not a music video')
 
             if int(res['lengthSeconds']) > 15 * 60:
-                raise PluginException('This is probably a live recording')
+                raise NotMusicException('This is probably a live recording')
         except KeyError:
             raise PluginException('Video not available')
 
@@ -275,13 +365,15 @@ class Youtube(ConverterBase):
         return t, art
 
     @classmethod
-    def convert(cls, uri: str) -> List[str]:
+    def convert(cls, uri: str, deadline: float = None) -> List[str]:
         title, artists = cls.get_title_and_artists(uri)
         if not artists:
-            raise PluginException('Artist not found.')
+            raise NotMusicException('Artist not found.')
         try:
-            return [YoutubeMusic.get_url_from_data(title, artists),
-                    Spotify.get_url_from_data(title, artists)]
+            return run_concurrently(
+                (YoutubeMusic.get_url_from_data, title, artists),
+                (Spotify.get_url_from_data, title, artists, deadline),
+                deadline=deadline)
         except InnenTudodHogyJoException:
             raise PluginException('Probably not a music video.')
 
@@ -298,7 +390,7 @@ class YoutubeMusic(ConverterBase):
         artists = artists or []
         log.debug(f'Searching for YoutubeMusic. Title: {title};'
                   f' Artists: {str(artists)}')
-        res = ytmusic.search(' '.join([title, *artists]), filter="songs")
+        res = urlmetadata.ytmusic.search(' '.join([title, *artists]), filter="songs")
         if not res:
             raise PluginException("Could not find track on YouTube Music: "
                                   + title + ' - ' + ', '.join(artists))
@@ -306,15 +398,13 @@ class YoutubeMusic(ConverterBase):
 
     @classmethod
     def get_title_and_artists(cls, uri) -> Tuple[str, List[str]]:
-        if match := re.match(cls.URI_BASE + r'/watch\?v=([^&]*)', uri):
-            track_id = match.group(1)
-        else:
+        if not (track_id := urlmetadata.youtube_video_id(uri)):
             raise PluginException('Invalid YouTube Music url')
 
-        res = ytmusic.get_song(track_id)
+        res = urlmetadata.get_song(track_id)
 
         if int(res['lengthSeconds']) > 15 * 60:
-            raise PluginException('This is probably a live recording')
+            raise NotMusicException('This is probably a live recording')
 
         pattern = re.compile(r'(\(.*\)|\[.*])')
         title_subbed, _ = pattern.subn('', res['title'])
@@ -334,8 +424,9 @@ class YoutubeMusic(ConverterBase):
             return cls.parse_title(res['title'])
 
     @classmethod
-    def convert(cls, uri) -> List[str]:
-        return [Spotify.get_url_from_data(*cls.get_title_and_artists(uri))]
+    def convert(cls, uri, deadline: float = None) -> List[str]:
+        return [Spotify.get_url_from_data(*cls.get_title_and_artists(uri),
+                                          deadline=deadline)]
 
 
 class Spotify(ConverterBase):
@@ -350,38 +441,79 @@ class Spotify(ConverterBase):
         return title.strip()
 
     @staticmethod
-    def _search(title: str, artists: List[str] = None) -> str:
-        def local_search(t, a):
-            if a:
-                r = call_with_retires(spotify.search, " ".join([t, "artist:", *a]))
-            else:
-                r = call_with_retires(spotify.search, t)
-
-            for item in r['tracks']['items']:
-                title_baseline = Spotify.strip_title(item['name'])
-                if title_baseline == title.lower():
-                    return item['external_urls']['spotify']
-            for a in artists:
-                t_temp = t + ' ' + a
-                r = call_with_retires(spotify.search, t_temp)
-                for item in r['tracks']['items']:
-                    title_baseline = Spotify.strip_title(item['name'])
-                    if title_baseline == title.lower():
-                        return item['external_urls']['spotify']
-            try:
-                print(r)
-                return r['tracks']['items'][0]['external_urls']['spotify']
-            except IndexError:
-                raise ValueError
+    def plan_searches(title: str, artists: List[str] = None) -> List[str]:
+        """Builds the search queries of a track, most specific first:
+        title with every artist, title with each artist, then title with
+        fewer and fewer artists and title alone. At most
+        MAX_SEARCH_CALLS queries are returned."""
+        artists = artists or []
+        queries = []
+        if artists:
+            queries.append(" ".join([title, "artist:", *artists]))
+            queries += [title + ' ' + a for a in artists]
+            queries += [" ".join([title, "artist:", *artists[:n]])
+                        for n in range(len(artists) - 1, 0, -1)]
+        queries.append(title)
+        return list(dict.fromkeys(queries))[:MAX_SEARCH_CALLS]
+
+    @staticmethod
+    def _match(title: str, result) -> Union[dict, None]:
+        """Returns the first track of a search result with the same
+        title, None if there is none"""
+        for item in result['tracks']['items'] if result else []:
+            if Spotify.strip_title(item['name']).lower() == title.lower():
+                return item
+        return None
+
+    @staticmethod
+    def _search(title: str, artists: List[str] = None,
+                deadline: float = None) -> str:
+        """Runs the most specific query first, the others only if it
+        didn't find the track. They run concurrently and the first track
+        with the same title wins; if there is none, the top result of
+        the most specific query that has one."""
+        queries = Spotify.plan_searches(title, artists)
+        results = {}
+
+        def finish(found):
+            remember_track(found)
+            return found['external_urls']['spotify']
+
+        first = search_executor.submit(call_with_retires, spotify.search,
+                                       queries[0])
+        try:
+            results[queries[0]] = first.result(timeout=remaining_time(deadline))
+        except concurrent.futures.TimeoutError:
+            raise ConversionTimeout('Conversion timed out')
+        except Exception:
+            log.warning(f'Spotify search failed: {queries[0]}')
+        if found := Spotify._match(title, results.get(queries[0])):
+            return finish(found)
+
+        futures = {search_executor.submit(call_with_retires, spotify.search, q): q
+                   for q in queries[1:]}
         try:
-            return local_search(title, artists)
-        except ValueError:
-            artists = artists[::-1][1:]
-            for artist in artists:
-                try:
-                    return local_search(title, artists)
-                except ValueError:
-                    artists.remove(artist)
+            for future in concurrent.futures.as_completed(
+                    futures, timeout=remaining_time(deadline)):
+                query = futures[future]
+                if future.exception() is not None:
+                    log.warning(f'Spotify search failed: {query}')
+                    continue
+                results[query] = future.result()
+                if found := Spotify._match(title, results[query]):
+                    return finish(found)
+        except concurrent.futures.TimeoutError:
+            log.warning(f'Spotify search timed out: {title}')
+        finally:
+            # the queued searches are not needed anymore
+            for future in futures:
+                future.cancel()
+
+        for query in queries:
+            if (result := results.get(query)) and result['tracks']['items']:
+                return finish(result['tracks']['items'][0])
+        if remaining_time(deadline) == 0:
+            raise ConversionTimeout('Conversion timed out')
         raise InnenTudodHogyJoException('Na erről tudod, hogy jó')
 
     @staticmethod
@@ -426,14 +558,16 @@ class Spotify(ConverterBase):
         return title, artist_list
 
     @classmethod
-    def get_url_from_data(cls, title: str, artists: List[str] = None) -> str:
-        return cls._search(title, artists)
+    def get_url_from_data(cls, title: str, artists: List[str] = None,
+                          deadline: float = None) -> str:
+        return cls._search(title, artists, deadline)
 
     @classmethod
     def get_title_and_artists(cls, uri) -> Tuple[str, List[str]]:
+        from spotipy.exceptions import SpotifyException
         try:
-            track = call_with_retires(spotify.track, uri)
-        except spotipy.exceptions.SpotifyException:
+            track = get_track(uri)
+        except SpotifyException:
             raise PluginException('Invalid spotify url')
 
         title = track["name"]
@@ -441,7 +575,7 @@ class Spotify(ConverterBase):
         return title, artists
 
     @classmethod
-    def convert(cls, uri) -> List[str]:
+    def convert(cls, uri, deadline: float = None) -> List[str]:
         return [YoutubeMusic.get_url_from_data(*cls.get_title_and_artists(uri))]
 
     @classmethod
@@ -449,29 +583,78 @@ class Spotify(ConverterBase):
         if not uri.startswith(cls.URI_BASE):
             return ()
 
-        track = call_with_retires(spotify.track, uri)
+        # usually found by the search or lookup of the conversion already
+        track = get_track(uri)
         return track['album']['images'][0]['url'], track['preview_url']
 
 
-def convert_uri(uri: str) -> Union[List[str], None]:
+def convert_uri(uri: str, deadline: float = None) -> Union[List[str], None]:
     log.info('Received URI: ' + uri)
     result = []
     if Youtube.check_uri(uri):
-        result = Youtube.convert(uri)
+        result = Youtube.convert(uri, deadline)
     elif YoutubeMusic.check_uri(uri):
-        result = YoutubeMusic.convert(uri)
+        result = YoutubeMusic.convert(uri, deadline)
     elif Spotify.check_uri(uri):
-        result = Spotify.convert(uri)
+        result = Spotify.convert(uri, deadline)
 
     log.info('Converted list of URIs: ' + str(result))
     return result
 
 
 def extract_track_info(uri: str):
-    converted_urls = convert_uri(uri)
+    """Converts a track url to the other services, and finds the album
+    cover and preview of the track. Results (and failures) are cached,
+    see conversion_cache.
+
+    Returns:
+        tuple: (converted urls, album cover url, preview url)
+    """
+    key = conversion_cache.normalize_url(uri)
+    if key is None:
+        return _extract_track_info(uri)
+
+    cache = conversion_cache.get_cache()
+    if (cached := cache.get(key)) is not None:
+        log.info(f'Conversion of {key} found in cache')
+        if cached.get('error') == 'InnenTudodHogyJoException':
+            raise InnenTudodHogyJoException(cached['message'])
+        if cached.get('error') == 'NotMusicException':
+            raise NotMusicException(cached['message'])
+        if cached.get('error'):
+            raise PluginException(cached['message'])
+        return cached['urls'], cached['album_cover'], cached['preview_url']
+
+    try:
+        urls, album_cover, preview_url = _extract_track_info(
+            conversion_cache.canonical_url(key))
+    except ConversionTimeout:
+        # might work next time, not cached
+        raise
+    except PluginException as e:
+        # only the properties of the video are sure to stay the same,
+        # the other failures (unavailable video, track not found) might
+        # be temporary
+        ttl = (conversion_cache.NEGATIVE_TTL if isinstance(e, NotMusicException)
+               else conversion_cache.TRANSIENT_TTL)
+        cache.put(key, {'error': type(e).__name__, 'message': str(e)}, ttl)
+        raise
+    cache.put(key, {'urls': urls, 'album_cover': album_cover,
+                    'preview_url': preview_url},
+              conversion_cache.POSITIVE_TTL)
+    return urls, album_cover, preview_url
+
+
+def _extract_track_info(uri: str):
+    deadline = time.monotonic() + CONVERSION_TIMEOUT
+    converted_urls = convert_uri(uri, deadline)
+    if remaining_time(deadline) == 0:
+        raise ConversionTimeout('Conversion timed out')
     urls = [*converted_urls, uri]
     track = None
     for url in urls:
+        # the spotify track is remembered from the conversion,
+        # this doesn't call the api again
         res = Spotify.get_album_cover_and_preview_url(url)
         if res:
             track = res
@@ -486,3 +669,12 @@ class PluginException(BaseException):
 
 class InnenTudodHogyJoException(PluginException):
     pass
+
+
+class ConversionTimeout(PluginException):
+    pass
+
+
+class NotMusicException(PluginException):
+    """The link is not a music track, it won't change later"""
+    pass
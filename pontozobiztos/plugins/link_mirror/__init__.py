@@ -3,13 +3,31 @@ from pontozobiztos.models.User import User
 
 from fbchat import GroupData
 import fbchat
-import requests
-from pontozobiztos.plugins.link_mirror import Converter
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from pontozobiztos.plugins.link_mirror import Converter, artist_gazetteer
+from pontozobiztos import chatscheduler, mediaworker, triggers
 
 import logging
 log = logging.getLogger("chatbot")
 
 MAX_RETRIES = 3
+UPLOAD_TIMEOUT = 30  # seconds, for the cover and the preview together
+
+# separate from the lookups of Converter.executor, so the uploads don't
+# delay the conversions. An upload that timed out keeps its worker until
+# it finishes, running futures can't be cancelled.
+upload_executor = ThreadPoolExecutor(max_workers=4,
+                                     thread_name_prefix='link-mirror-upload')
+
+TRIGGERS = [triggers.pattern(r'^https://')]
+
+
+def init(thread, *args, **kwargs):
+    # the artists found by the conversions are saved in the background
+    chatscheduler.get_scheduler().add_job(
+        artist_gazetteer.flush, 'interval',
+        seconds=artist_gazetteer.FLUSH_INTERVAL)
 
 
 def upload_with_retries(client, file, ftype):
@@ -51,19 +69,28 @@ def on_message(message, author):
         log.info(f'Could not convert {message.text}. Reason: {e}')
         return False
 
-    fb_album = []
-    if album_cover:
-        album_cover_file = requests.get(album_cover).content
-        fb_album = upload_with_retries(client, album_cover_file, 'png')
+    def download_and_upload(url, ftype):
+        return upload_with_retries(client, mediaworker.fetch(url).getvalue(), ftype)
 
-    fb_preview = []
-    if preview_url:
-        preview_url_file = requests.get(preview_url).content
-        fb_preview = upload_with_retries(client, preview_url_file, 'mp3')
+    # the cover and the preview are downloaded and uploaded at the same time
+    futures = {ftype: upload_executor.submit(download_and_upload, url, ftype)
+               for url, ftype in ((album_cover, 'png'), (preview_url, 'mp3'))
+               if url}
+    done, _ = concurrent.futures.wait(futures.values(), timeout=UPLOAD_TIMEOUT)
+    uploads = {}
+    for ftype, future in futures.items():
+        if future not in done:
+            log.error(f'Upload of the {ftype} of {message.text} timed out')
+        elif future.exception() is not None:
+            log.error(f'Upload of the {ftype} of {message.text} failed: '
+                      f'{future.exception()}')
+        else:
+            uploads[ftype] = future.result()
+    fb_album = uploads.get('png') or []
+    fb_preview = uploads.get('mp3') or []
 
     msg_text = '\n\n'.join(converted_uris)
     log.debug(f'Sending URL: {msg_text}')
-    files = fb_album + fb_preview
     message.thread.send_text(text=msg_text, files=fb_album)
     message.thread.send_text(text=None, files=fb_preview)
     return True
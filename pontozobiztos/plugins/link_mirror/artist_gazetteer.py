@@ -0,0 +1,146 @@
+"""Local dictionary of known artist names, persisted in the artists
+collection. Names are compared normalized (unidecoded, lowercase, single
+spaces). Only names that are not in the gazetteer are looked up on
+Spotify, and the name is added to it if that lookup finds the artist.
+
+The gazetteer is seeded from the tracks of the conversions and from the
+historical links (scripts/seed_artist_gazetteer.py). New names are only
+added in memory during the conversions, they are saved by flush(), which
+link_mirror schedules every FLUSH_INTERVAL seconds.
+"""
+
+from pontozobiztos import chatmongo, lazy
+from unidecode import unidecode
+import pymongo.errors
+import threading
+import logging
+
+log = logging.getLogger('chatbot.link_mirror')
+
+FLUSH_INTERVAL = 60  # seconds
+
+
+def normalize_artist(name):
+    return ' '.join(unidecode(name).lower().split())
+
+
+class ArtistGazetteer:
+    def __init__(self, artists=None):
+        """
+        Args:
+            artists (dict): normalized name -> name
+        """
+        self.artists = dict(artists or {})
+        # names Spotify didn't know in this process, not persisted
+        self.unknown = set()
+        # added since the last flush
+        self._unsaved = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls):
+        try:
+            return cls(chatmongo.get_artists())
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f'Could not load artists: {e}')
+            return cls()
+
+    def __contains__(self, name):
+        return normalize_artist(name) in self.artists
+
+    def __len__(self):
+        return len(self.artists)
+
+    def add(self, *names):
+        """Adds artist names to the gazetteer, the new ones are saved
+        by the next flush"""
+        with self._lock:
+            for name in names:
+                key = normalize_artist(name)
+                if key and key not in self.artists:
+                    self.artists[key] = name
+                    self.unknown.discard(key)
+                    self._unsaved[key] = name
+
+    def flush(self):
+        """Saves the artists added since the last flush"""
+        with self._lock:
+            new, self._unsaved = self._unsaved, {}
+        if not new:
+            return
+        try:
+            self.save(new)
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f'Could not save artists: {e}')
+            # tried again by the next flush
+            with self._lock:
+                self._unsaved = {**new, **self._unsaved}
+
+    def save(self, artists):
+        """Persists new artists (normalized name -> name)"""
+        chatmongo.add_artists(artists)
+
+    def add_track(self, track):
+        """Adds the artists of a spotify track object"""
+        self.add(*(artist['name'] for artist in track.get('artists', ())))
+
+    def is_artist(self, name, search=None):
+        """Checks whether name is an artist.
+
+        Args:
+            name (str): the name to check
+            search (callable): looks up unknown names, returns a list of
+                artist names (e.g. from spotify.search). Only the one
+                matching name is added, the search is fuzzy.
+
+        Returns:
+            bool: True if the name is a known artist
+        """
+        key = normalize_artist(name)
+        if key in self.artists:
+            return True
+        if key in self.unknown or search is None:
+            return False
+        found = [a for a in search(name) or [] if normalize_artist(a) == key]
+        if found:
+            self.add(found[0])
+            return True
+        with self._lock:
+            self.unknown.add(key)
+        return False
+
+
+gazetteer = lazy.LazyObject(ArtistGazetteer.load, 'artist gazetteer')
+
+
+def get_gazetteer() -> ArtistGazetteer:
+    return gazetteer.get()
+
+
+# artist names of accepted tracks, waiting for the gazetteer to be loaded
+_pending = []
+_pending_lock = threading.Lock()
+
+
+def add_track(track):
+    """Adds the artists of an accepted spotify track. Doesn't load or
+    save the gazetteer, it's cheap enough for the conversions; the
+    names are added by the next flush if the gazetteer isn't loaded
+    yet."""
+    names = [artist['name'] for artist in track.get('artists', ())]
+    if gazetteer.loaded:
+        gazetteer.get().add(*names)
+        return
+    with _pending_lock:
+        _pending.extend(names)
+
+
+def flush():
+    """Adds the pending artists and saves the new ones"""
+    with _pending_lock:
+        names = _pending[:]
+        _pending.clear()
+    if names:
+        get_gazetteer().add(*names)
+    if gazetteer.loaded:
+        get_gazetteer().flush()
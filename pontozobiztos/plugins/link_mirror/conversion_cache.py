@@ -0,0 +1,125 @@
+"""Two level cache of link conversions: an in-process LRU in front of
+the link_conversions collection (a TTL collection, mongo removes the
+expired documents). The key is the normalized url of the track, so the
+different forms of a link (youtu.be, tracking parameters, ...) share
+the entry, and all of them are converted through the same canonical url.
+
+Failed conversions are cached too, for a shorter time: a day if the
+link is not music (not a music video, live recording), a few minutes
+for the other failures (unavailable video, track not found), which
+might be temporary.
+"""
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pontozobiztos import chatmongo
+import pymongo.errors
+import threading
+import logging
+import re
+
+log = logging.getLogger('chatbot.link_mirror')
+
+POSITIVE_TTL = 30 * 24 * 60 * 60  # seconds
+NEGATIVE_TTL = 24 * 60 * 60  # seconds
+TRANSIENT_TTL = 5 * 60  # seconds
+LRU_SIZE = 512
+
+CANONICAL_URLS = {
+    'youtube': 'https://www.youtube.com/watch?v={}',
+    'ytmusic': 'https://music.youtube.com/watch?v={}',
+    'spotify': 'https://open.spotify.com/track/{}',
+}
+
+URL_PATTERNS = [
+    ('youtube', re.compile(r'^https://(?:www\.|m\.)?youtube\.com/watch\?(?:.*&)?v=([\w-]+)')),
+    ('youtube', re.compile(r'^https://youtu\.be/([\w-]+)')),
+    ('ytmusic', re.compile(r'^https://music\.youtube\.com/watch\?(?:.*&)?v=([\w-]+)')),
+    ('spotify', re.compile(r'^https://open\.spotify\.com/(?:intl-\w+/)?track/(\w+)')),
+]
+
+
+def normalize_url(url):
+    """Returns the cache key of a track url, None if it's not the url
+    of a track.
+
+    Args:
+        url (str): url of the track
+
+    Returns:
+        str: e.g. 'youtube:dQw4w9WgXcQ'
+    """
+    url = url.strip()
+    for service, pattern in URL_PATTERNS:
+        if match := pattern.match(url):
+            return f'{service}:{match.group(1)}'
+    return None
+
+
+def canonical_url(key):
+    """Returns the canonical url of a normalized url (cache key)"""
+    service, track_id = key.split(':', 1)
+    return CANONICAL_URLS[service].format(track_id)
+
+
+class ConversionCache:
+    def __init__(self, maxsize=LRU_SIZE):
+        self.maxsize = maxsize
+        # key -> document with expires_at, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _remember(self, key, doc):
+        with self._lock:
+            self._entries[key] = doc
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached result of key, None if it's not cached.
+
+        Args:
+            key (str): normalized url
+
+        Returns:
+            dict: the cached result
+        """
+        with self._lock:
+            doc = self._entries.get(key)
+            if doc is not None:
+                if doc['expires_at'] > datetime.utcnow():
+                    self._entries.move_to_end(key)
+                    return doc
+                del self._entries[key]
+        try:
+            doc = chatmongo.get_cached_conversion(key)
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f'Could not read the conversion cache: {e}')
+            return None
+        if doc is not None:
+            self._remember(key, doc)
+        return doc
+
+    def put(self, key, result, ttl):
+        """Caches a conversion result.
+
+        Args:
+            key (str): normalized url
+            result (dict): the result
+            ttl (int): seconds the result is valid for
+        """
+        doc = {**result,
+               'expires_at': datetime.utcnow() + timedelta(seconds=ttl)}
+        self._remember(key, doc)
+        try:
+            chatmongo.cache_conversion(key, result, ttl)
+        except pymongo.errors.PyMongoError as e:
+            log.warning(f'Could not write the conversion cache: {e}')
+
+
+cache = ConversionCache()
+
+
+def get_cache() -> ConversionCache:
+    return cache
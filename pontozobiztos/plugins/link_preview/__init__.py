@@ -1,15 +1,14 @@
 import requests
 import fbchat
-from webpreview import web_preview
 import re
 import logging
-import ytmusicapi
+from pontozobiztos import triggers, urlmetadata
 
 logger = logging.getLogger("chatbot")
 
 MAX_RETRIES = 3
 
-youtube = ytmusicapi.YTMusic()
+TRIGGERS = [triggers.pattern(r'https://\S')]
 
 
 def upload_with_retries(client, image):
@@ -23,10 +22,10 @@ def upload_with_retries(client, image):
 
 
 def get_ytvideo_length(url):
-    if match := re.search(r'(youtube\.com/watch\?.*v=([^&]+)|youtu\.be/([^?]+))', url):
-        video_id = match.groups()[1]
+    if video_id := urlmetadata.youtube_video_id(url):
         try:
-            duration_in_s = int(youtube.get_song(video_id)['lengthSeconds'])
+            # link_mirror asks for the same song, it's fetched only once
+            duration_in_s = int(urlmetadata.get_song(video_id)['lengthSeconds'])
         except KeyError:
             logger.info('Couldn\'t retrieve YouTube video with url: ' + url)
             return ''
@@ -50,9 +49,7 @@ def on_message(message, author):
         logger.info('Extracted url: ' + url)
         client = fbchat.Client(session=message.thread.session)
         try:
-            title, description, image_url = web_preview(
-                url, parser='html.parser', timeout=2000,
-                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36'})
+            title, description, image_url = urlmetadata.get_web_preview(url)
         except requests.exceptions.InvalidURL:
             return False
         except requests.exceptions.Timeout:
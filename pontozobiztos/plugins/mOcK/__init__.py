@@ -1,3 +1,8 @@
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.pattern(r'@cseh|botond', ignore_case=True)]
+
+
 def on_message(message, author):
     """
         Args:
@@ -6,6 +6,9 @@ import re
 import random
 
 
+# only runs as a scheduled job
+TRIGGERS = []
+
 group_thread: fbchat.GroupData
 
 
@@ -1,3 +1,8 @@
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.pattern(r'^\s*\S{1,3}ing\s*$', ignore_case=True)]
+
+
 def on_message(message, author):
     """
         Args:
@@ -1,13 +1,16 @@
-from pontozobiztos import chatmongo
+from pontozobiztos import chatmongo, imageindex, imagehashing, lazy, mediaworker, triggers
+from concurrent.futures import TimeoutError
 import fbchat
-import imagehash
 import logging
 import random
-import requests
-from PIL import Image
 
 log = logging.getLogger('chatbot')
 
+TRIGGERS = [triggers.attachment(fbchat.ImageAttachment)]
+
+DOWNLOAD_TIMEOUT = 30  # seconds
+MAX_DISTANCE = 4  # maximum Hamming distance of phashes to count as repost
+
 
 re_strings = ['Olvasni kéne', 'Voltmár', 'REEEEEEE', 'vótmá',
               'vót', 'R E P O S T', 're', 'mámegint?', 'hányszor fogod még?',
@@ -25,8 +28,9 @@ def random_reply():
         return ''.join(votma_list)
 
 
-def init():
-    pass
+# the hashes of the stored images are loaded into the index on the first
+# image (or by the warm-up), not during the startup
+image_index = lazy.LazyObject(chatmongo.load_image_index, 'repost image index')
 
 
 def on_message(message, author):
@@ -43,14 +47,18 @@ def on_message(message, author):
                 continue
 
             try:
-                msg_in_db = next(chatmongo.get_message_collection().find({'_id': message.id}))
-                img_hash = next(att for att in msg_in_db['attachments'] if att['uid'] == img.id)['image_hash']
-            except (StopIteration, KeyError):
+                if (download := mediaworker.get_pending(img.id)) is not None:
+                    # the media workers are still on it, no need to download it twice
+                    img_hash = download.result(timeout=DOWNLOAD_TIMEOUT)['image_hash']
+                else:
+                    msg_in_db = next(chatmongo.get_message_collection().find({'_id': message.id}))
+                    img_hash = next(att for att in msg_in_db['attachments'] if att['uid'] == img.id)['image_hash']
+            except (StopIteration, KeyError, TimeoutError):
                 # if not in db (different chat), download again
                 largest_image = sorted(list(img.previews),
                                        key=lambda i: i.width or 0)[-1]
-                img = Image.open(requests.get(largest_image.url, stream=True).raw)
-                img_hash = str(imagehash.phash(img))
+                img_hash = imagehashing.hash_images(
+                    [mediaworker.fetch(largest_image.url)])[0]['phash']
 
             reposts = find_reposts(img_hash)
             reposts = [rep for rep in reposts if rep['_id'] != message.id]
@@ -68,23 +76,26 @@ def on_message(message, author):
         return False
 
 
-def find_reposts(image_hash):
-    result = chatmongo.get_message_collection().aggregate([
-        {'$unwind': '$attachments'},
-        {'$match': {'attachments.type': 'image'}},
-        {'$match': {'attachments.image_hash': image_hash}},
-        {'$replaceWith': {
-            '_id': '$_id',
-            'hash': '$attachments.image_hash',
-            'created_at': '$created_at'
-        }},
-        {'$sort': {'created_at': 1}}
-    ])
-    return list(result)
+def find_reposts(image_hash, max_distance=MAX_DISTANCE):
+    """Finds the stored images that are within max_distance of
+    image_hash.
+
+    Args:
+        image_hash (str): phash of the image
+        max_distance (int): maximum Hamming distance
+
+    Returns:
+        list: list of dicts (_id, hash distance, created_at) ordered
+            by created_at
+    """
+    image_index.get()
+    return [{'_id': mid, 'distance': distance, 'created_at': created_at}
+            for distance, mid, created_at
+            in imageindex.get_index().query(image_hash, max_distance)]
 
 
 if __name__ == '__main__':
     from PIL import Image
-    init()
+    import imagehash
     imghash = imagehash.phash(Image.open('20180920205858_u100001274083888_mid.$gAADTaOUX9sVsKgyfYFl-MdLnwIWo_a1937288356574368.jpg'))
     print(find_reposts(str(imghash)))
@@ -1,4 +1,8 @@
 from . import szerenchatapp
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.pattern(r'^(?=!).*?!(?:d\d|k52|szerenchat)',
+                             ignore_case=True)]
 
 
 on_message = szerenchatapp.on_message
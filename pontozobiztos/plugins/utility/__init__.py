@@ -1,6 +1,10 @@
 """This will be included into the help function."""
 
 from . import utilityapp
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.command(*(c for cmd in utilityapp.commands
+                               for c in cmd['cmd']))]
 
 # init = utilityapp.init
 on_message = utilityapp.on_message
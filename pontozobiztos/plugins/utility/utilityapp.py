@@ -71,15 +71,12 @@ def points_all(thread, author, message, *args):
         author(User)
         message(fbchat.Message)
     """
-    user_ids = chatmongo.get_user_ids()
-    point_list = []
-    for uid in user_ids:
-        user = User(uid)
-        point_list.append((user.fullname, user.points_sum, user.multiplier))
-    point_list.sort(key=lambda x: x[1], reverse=True)
     text = "Összesített pontok:\n"
-    for name, point, mult in point_list:
-        text += f'{name}: {point} pts - {mult}x\n'
+    leaderboard = list(chatmongo.get_leaderboard())
+    multipliers = chatmongo.get_users_multiplier(*[user['_id'] for user in leaderboard])
+    for user in leaderboard:
+        mult = multipliers[user['_id']]
+        text += f'{user["fullname"]}: {user["points"]} pts - {mult}x\n'
     thread.send_text(text, reply_to_id=message.id)
     return True
 
@@ -1,5 +1,8 @@
 import requests
 import fbchat
+from pontozobiztos import triggers
+
+TRIGGERS = [triggers.command('link')]
 
 
 def on_message(message, author):
@@ -0,0 +1,105 @@
+"""Calculates the missing hashes (phash, dhash, whash) of every stored
+image. Images are hashed in batches spread across a process pool and the
+results are written back with bulk updates. Only images without a dhash
+are selected, so the script can be stopped and restarted any time.
+Images that can't be opened or decoded get '' hashes and are not
+retried."""
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pontozobiztos import chatmongo, imagehashing, mediastore
+import pymongo
+import itertools
+import logging
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('chatbot')
+
+BATCH_SIZE = 64
+WORKERS = os.cpu_count()
+MAX_PENDING = 2 * WORKERS  # batches submitted to the pool at a time
+
+
+def open_image(att):
+    try:
+        return mediastore.open_blob(att['path'])
+    except Exception as e:
+        # e.g. a file removed since the batch was made or a broken
+        # GridFS entry, the rest of the batch is still hashed
+        log.warning(f'Could not open image {att["path"]}: {e}')
+        return None
+
+
+def hash_batch(batch):
+    images = [open_image(att) for att in batch]
+    opened = [image for image in images if image is not None]
+    try:
+        hashes = iter(imagehashing.hash_images(opened))
+    finally:
+        for image in opened:
+            image.close()
+    return [(att['_id'], att['uid'],
+             next(hashes) if image is not None
+             else dict.fromkeys(imagehashing.HASH_TYPES, ''))
+            for att, image in zip(batch, images)]
+
+
+def missing_images():
+    return chatmongo.get_message_collection().aggregate([
+        {'$match': {'attachments': {'$elemMatch': {
+            'type': 'image', 'dhash': {'$exists': False}}}}},
+        {'$unwind': '$attachments'},
+        {'$match': {'attachments.type': 'image',
+                    'attachments.dhash': {'$exists': False},
+                    'attachments.path': {'$exists': True}}},
+        {'$project': {'uid': '$attachments.uid',
+                      'path': '$attachments.path'}}
+    ])
+
+
+def batches(cursor):
+    batch = []
+    for att in cursor:
+        if mediastore.exists(att['path']):
+            batch.append(att)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    message_coll = chatmongo.get_message_collection()
+    done = 0
+    start = time.perf_counter()
+    pending = set()
+    todo = batches(missing_images())
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        while True:
+            # only a few batches are submitted ahead, not the whole
+            # collection at once
+            for batch in itertools.islice(todo, MAX_PENDING - len(pending)):
+                pending.add(pool.submit(hash_batch, batch))
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results = future.result()
+                message_coll.bulk_write([
+                    pymongo.UpdateOne(
+                        {'_id': mid, 'attachments.uid': uid},
+                        {'$set': {'attachments.$.' + k: v for k, v
+                                  in chatmongo.serialize_image_hashes(h).items()}})
+                    for mid, uid, h in results
+                ], ordered=False)
+                done += len(results)
+            elapsed = time.perf_counter() - start
+            log.info(f'Hashed {done} images, {done / elapsed:.1f} images/s')
+    log.info(f'Finished. Hashed {done} images in '
+             f'{time.perf_counter() - start:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Offline benchmark and accuracy check of the link_mirror Converter.
+
+    python -m pontozobiztos.scripts.benchmark_converter record [corpus] [fixtures]
+    python -m pontozobiztos.scripts.benchmark_converter replay [corpus] [fixtures]
+
+The corpus is a text file with one link per line (e.g. the output of
+get_youtube_links.py). A line can have the expected spotify url after a
+tab, otherwise the recorded result is expected.
+
+record converts every link with the live Spotify and YouTube Music
+clients and saves their responses to the fixtures file. replay runs the
+conversions again against a stand-in client that serves the recorded
+responses, without network access, and reports:
+    - conversion time and API calls per conversion (by method)
+    - match accuracy against the expected urls
+    - throughput of the title parser on the recorded titles
+
+The conversion cache is bypassed and the artist gazetteer starts empty
+and is not persisted, so runs are comparable.
+"""
+
+from pontozobiztos import lazy, urlmetadata
+from pontozobiztos.plugins.link_mirror import Converter, artist_gazetteer, conversion_cache
+from collections import Counter
+import importlib
+import json
+import logging
+import sys
+import threading
+import time
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('chatbot')
+
+CORPUS_FILE = 'pontozobiztos/plugins/link_mirror/youtube_links.txt'
+FIXTURES_FILE = 'pontozobiztos/plugins/link_mirror/converter_fixtures.json'
+PARSE_ROUNDS = 20
+
+
+class FixtureError(Exception):
+    pass
+
+
+class MissingFixture(FixtureError):
+    pass
+
+
+def fixture_key(service, method, args, kwargs):
+    return f'{service}.{method}:' + json.dumps([args, kwargs], sort_keys=True)
+
+
+def record_exception(e):
+    """Returns the fixture of an exception raised by an API call"""
+    try:
+        args = json.loads(json.dumps(e.args))
+    except (TypeError, ValueError):
+        args = [str(e)]
+    return {'exception': f'{type(e).__module__}.{type(e).__qualname__}',
+            'args': args, 'message': str(e)}
+
+
+def replay_exception(fixture):
+    """Returns the recorded exception of a fixture, of the same class
+    (e.g. spotipy's SpotifyException, requests' ConnectionError), so the
+    converter handles it the same way as when it was recorded"""
+    module, _, name = fixture['exception'].rpartition('.')
+    try:
+        exc_type = importlib.import_module(module or 'builtins')
+        for attr in name.split('.'):
+            exc_type = getattr(exc_type, attr)
+    except (ImportError, AttributeError):
+        exc_type = None
+    if not (isinstance(exc_type, type) and issubclass(exc_type, Exception)):
+        return FixtureError(f"{fixture['exception']}: {fixture['message']}")
+    args = fixture.get('args', [fixture['message']])
+    try:
+        return exc_type(*args)
+    except TypeError:
+        # the constructor takes other arguments than args
+        e = exc_type.__new__(exc_type)
+        e.args = tuple(args)
+        return e
+
+
+class CountingClient:
+    """Counts the calls of the API methods by service.method"""
+
+    def __init__(self, service):
+        self.service = service
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.calls[f'{self.service}.{method}'] += 1
+
+
+class RecordingClient(CountingClient):
+    """Forwards the calls to the live client and records the responses"""
+
+    def __init__(self, service, client, fixtures):
+        super().__init__(service)
+        self.client = client
+        self.fixtures = fixtures
+
+    def __getattr__(self, method):
+        func = getattr(self.client, method)
+
+        def call(*args, **kwargs):
+            self._count(method)
+            key = fixture_key(self.service, method, args, kwargs)
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                self.fixtures[key] = record_exception(e)
+                raise
+            self.fixtures[key] = {'response': response}
+            return response
+        return call
+
+
+class FixtureClient(CountingClient):
+    """Local stand-in of an API client serving recorded responses"""
+
+    def __init__(self, service, fixtures):
+        super().__init__(service)
+        self.fixtures = fixtures
+        self.missing = 0
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            self._count(method)
+            key = fixture_key(self.service, method, args, kwargs)
+            if key not in self.fixtures:
+                self.missing += 1
+                raise MissingFixture(key)
+            fixture = self.fixtures[key]
+            if 'exception' in fixture:
+                raise replay_exception(fixture)
+            return fixture['response']
+        return call
+
+
+class OfflineGazetteer(artist_gazetteer.ArtistGazetteer):
+    def save(self, artists):
+        pass
+
+
+def read_corpus(path):
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            link, _, expected = line.strip().partition('\t')
+            if link and (key := conversion_cache.normalize_url(link)):
+                corpus.append((key, expected or None))
+    return list(dict.fromkeys(corpus))
+
+
+def convert(key):
+    """Converts a link like the plugin does, without the cache. The
+    artists found are added to the gazetteer right after the conversion,
+    not by the scheduled flush, so runs are comparable."""
+    try:
+        urls, _, _ = Converter._extract_track_info(conversion_cache.canonical_url(key))
+        return {'urls': urls}
+    except Converter.PluginException as e:
+        return {'error': type(e).__name__, 'message': str(e)}
+    except Exception as e:
+        # a crash of the converter counts as a wrong result
+        log.exception(f'Conversion of {key} failed')
+        return {'error': type(e).__name__, 'message': str(e)}
+    finally:
+        artist_gazetteer.flush()
+
+
+def spotify_url(result):
+    return next((u for u in result.get('urls', [])
+                 if u.startswith(Converter.Spotify.URI_BASE)), None)
+
+
+def install_clients(spotify, ytmusic):
+    Converter.spotify = spotify
+    urlmetadata.ytmusic = ytmusic
+    urlmetadata.clear()
+    Converter._tracks.clear()
+    artist_gazetteer.gazetteer = lazy.LazyObject(
+        OfflineGazetteer, 'offline artist gazetteer', warm_up=False)
+
+
+def record(corpus, fixtures_file):
+    fixtures = {}
+    spotify = RecordingClient('spotify', Converter.create_spotify(), fixtures)
+    ytmusic = RecordingClient('ytmusic', urlmetadata.create_ytmusic(), fixtures)
+    install_clients(spotify, ytmusic)
+
+    results = {}
+    for key, _ in corpus:
+        results[key] = convert(key)
+        log.info(f'{key}: {results[key]}')
+    with open(fixtures_file, 'w') as f:
+        json.dump({'fixtures': fixtures, 'results': results}, f)
+    log.info(f'Recorded {len(fixtures)} responses of {len(corpus)} links '
+             f'to {fixtures_file}')
+
+
+def replay(corpus, fixtures_file):
+    with open(fixtures_file) as f:
+        recording = json.load(f)
+    spotify = FixtureClient('spotify', recording['fixtures'])
+    ytmusic = FixtureClient('ytmusic', recording['fixtures'])
+    install_clients(spotify, ytmusic)
+
+    correct = checked = 0
+    start = time.perf_counter()
+    for key, expected in corpus:
+        result = convert(key)
+        if expected is not None:
+            ok = spotify_url(result) == expected
+        elif (expected := recording['results'].get(key)) is not None:
+            ok = result == expected
+        else:
+            continue
+        checked += 1
+        correct += ok
+        if not ok:
+            log.info(f'Mismatch {key}: expected {expected}, got {result}')
+    elapsed = time.perf_counter() - start
+
+    calls = spotify.calls + ytmusic.calls
+    n = len(corpus) or 1
+    log.info(f'Converted {len(corpus)} links in {elapsed:.2f} s '
+             f'({elapsed / n * 1000:.1f} ms/link)')
+    log.info(f'API calls per conversion: {sum(calls.values()) / n:.2f} '
+             + ', '.join(f'{k}: {v / n:.2f}' for k, v in sorted(calls.items())))
+    log.info(f'Missing fixtures: {spotify.missing + ytmusic.missing}')
+    if checked:
+        log.info(f'Accuracy: {correct}/{checked} ({correct / checked:.1%})')
+
+    # the gazetteer is warm now, parsing doesn't call the api
+    titles = [fixture['response']['title']
+              for key, fixture in recording['fixtures'].items()
+              if key.startswith('ytmusic.get_song:')
+              and isinstance(fixture.get('response'), dict)
+              and 'title' in fixture['response']]
+    if titles:
+        before = sum(calls.values())
+        start = time.perf_counter()
+        for _ in range(PARSE_ROUNDS):
+            for title in titles:
+                try:
+                    Converter.ConverterBase.parse_title(title)
+                except FixtureError:
+                    pass
+        elapsed = time.perf_counter() - start
+        parsed = PARSE_ROUNDS * len(titles)
+        after = sum((spotify.calls + ytmusic.calls).values())
+        log.info(f'Parsed {parsed} titles in {elapsed:.2f} s '
+                 f'({parsed / elapsed:.0f} titles/s, {after - before} API calls)')
+
+
+def main():
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'replay'
+    corpus = read_corpus(sys.argv[2] if len(sys.argv) > 2 else CORPUS_FILE)
+    fixtures_file = sys.argv[3] if len(sys.argv) > 3 else FIXTURES_FILE
+    if mode == 'record':
+        record(corpus, fixtures_file)
+    elif mode == 'replay':
+        replay(corpus, fixtures_file)
+    else:
+        log.error(f'Unknown mode: {mode}, use record or replay')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""Measures the startup cost of the counting game: the import time of
+counting_app, and the time it takes to provide the number words up to
+500 when they have to be generated (first start) and when they are
+loaded from the saved table."""
+
+from pontozobiztos.plugins.counting_game.number_matcher import NumberMatcher
+from pontozobiztos.plugins.counting_game.vocabulary import NumberVocabulary
+from pontozobiztos.plugins.counting_game import counting_app
+import statistics
+import subprocess
+import sys
+import tempfile
+import logging
+import time
+import os
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('chatbot')
+
+RUNS = 5
+NUMBER = 480
+
+IMPORT_CODE = ('import time; t = time.perf_counter(); '
+               'import pontozobiztos.plugins.counting_game.counting_app; '
+               'print(time.perf_counter() - t)')
+
+
+def measure_import():
+    times = []
+    for _ in range(RUNS):
+        out = subprocess.run([sys.executable, '-c', IMPORT_CODE],
+                             capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def measure_vocabulary(path):
+    vocabulary = NumberVocabulary(NumberMatcher(counting_app.FUZZY_LIMIT),
+                                  counting_app.accepted_languages, path)
+    start = time.perf_counter()
+    vocabulary.ensure(NUMBER)
+    return time.perf_counter() - start
+
+
+def main():
+    log.info(f'Import of counting_app: {measure_import() * 1000:.1f} ms '
+             f'(median of {RUNS})')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'number_words.json')
+        log.info(f'Number words up to {NUMBER}, generated: '
+                 f'{measure_vocabulary(path) * 1000:.1f} ms')
+        log.info(f'Number words up to {NUMBER}, loaded: '
+                 f'{measure_vocabulary(path) * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+"""Moves the media files from the old flat IMAGE/VIDEO/AUDIO directories
+into the content-addressed media store (MEDIA_BACKEND). Duplicates
+are stored only once. Safe to run multiple times."""
+
+from pontozobiztos import chatmongo
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+migrated, deduplicated, missing = chatmongo.migrate_media_to_store()
+print(f"Migrated {migrated} files ({deduplicated} duplicates), "
+      f"{missing} files were missing")
@@ -0,0 +1,11 @@
+"""Moves the points embedded in the user documents to the points
+ledger collection. The bot runs this at startup too. Safe to run
+multiple times."""
+
+from pontozobiztos import chatmongo
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+migrated = chatmongo.migrate_embedded_points()
+print(f"Migrated {migrated} points")
@@ -34,8 +34,8 @@ before = None
 def main():
     global before
     data = thread._fetch_messages(100, before)
-    for msg in data:
-        chatmongo.insert_or_update_message(msg)
+    inserted, updated = chatmongo.insert_or_update_messages(data)
+    print(f"Inserted: {inserted}, updated: {updated}")
     before = data[0].created_at
     time.sleep(random.uniform(0, 3))
 
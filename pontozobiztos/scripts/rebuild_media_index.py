@@ -0,0 +1,10 @@
+"""Rebuilds the attachment id -> path index from the attachments stored
+in the messages collection."""
+
+from pontozobiztos import chatmongo
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+indexed = chatmongo.rebuild_media_index()
+print(f"Indexed {indexed} media files")
@@ -0,0 +1,15 @@
+"""Recalculates the season totals from the points ledger. Rebuilds the
+current season by default, or the season containing the date given as
+the first argument (YYYY.mm.dd)."""
+
+from pontozobiztos import chatmongo
+from datetime import datetime
+import logging
+import sys
+
+logging.basicConfig(level=logging.INFO)
+
+date = datetime.strptime(sys.argv[1], '%Y.%m.%d') if len(sys.argv) > 1 else None
+chatmongo.create_indexes()
+users = chatmongo.rebuild_season_totals(date)
+print(f"Rebuilt season totals of {users} users")
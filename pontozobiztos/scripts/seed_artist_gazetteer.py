@@ -0,0 +1,67 @@
+"""Seeds the artist gazetteer of link_mirror from the music links posted
+in the chat (the same links get_youtube_links.py collects). Spotify
+tracks are looked up in batches of 50, YouTube and YouTube Music links
+one by one. Safe to run multiple times, known artists are skipped."""
+
+from pontozobiztos import chatmongo, urlmetadata
+from pontozobiztos.plugins.link_mirror import Converter, artist_gazetteer
+import logging
+import re
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger('chatbot')
+
+SPOTIFY_BATCH_SIZE = 50  # maximum of spotify.tracks
+
+LINK_PATTERN = re.compile(r'^https://(open\.spotify\.com/track|youtu\.be/'
+                          r'|(www\.|music\.)?youtube\.com/watch)')
+
+
+def historical_links():
+    cursor = chatmongo.get_message_collection().find(
+        {'text': LINK_PATTERN}, {'text': 1})
+    return {m['text'].split()[0] for m in cursor}
+
+
+def youtube_artists(url):
+    if not (video_id := urlmetadata.youtube_video_id(url)):
+        return []
+    try:
+        song = urlmetadata.get_song(video_id)
+        if song.get('category') != 'Music':
+            # the channel of other videos is not necessarily an artist
+            return []
+        return [a['name'] if isinstance(a, dict) else a
+                for a in song.get('artists') or []]
+    except Exception as e:
+        log.warning(f'Could not look up {url}: {e}')
+        return []
+
+
+def main():
+    gazetteer = artist_gazetteer.get_gazetteer()
+    known = len(gazetteer)
+    links = historical_links()
+    log.info(f'Found {len(links)} music links, {known} known artists')
+
+    track_ids = [i for i in map(Converter.spotify_track_id, links) if i]
+    for start in range(0, len(track_ids), SPOTIFY_BATCH_SIZE):
+        batch = track_ids[start:start + SPOTIFY_BATCH_SIZE]
+        result = Converter.call_with_retires(Converter.spotify.tracks, batch)
+        for track in (result or {}).get('tracks', []):
+            if track:
+                gazetteer.add_track(track)
+        gazetteer.flush()
+        log.info(f'Looked up {start + len(batch)} spotify tracks')
+
+    for url in links:
+        if not Converter.spotify_track_id(url):
+            gazetteer.add(*youtube_artists(url))
+    gazetteer.flush()
+
+    log.info(f'Added {len(gazetteer) - known} artists, '
+             f'{len(gazetteer)} artists in the gazetteer')
+
+
+if __name__ == '__main__':
+    main()
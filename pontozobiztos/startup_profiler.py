@@ -0,0 +1,55 @@
+"""Startup profiler. Records how long the steps of the startup (module
+imports, plugin imports and inits, login, ...) take, and logs a report
+of them once the bot is listening.
+
+    with startup_profiler.measure('import plugin link_mirror'):
+        importlib.import_module(...)
+"""
+
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger("chatbot")
+
+REPORT_LIMIT = 20  # slowest steps shown in the report
+
+_started_at = time.perf_counter()
+_timings = []  # (name, seconds)
+_lock = threading.Lock()
+
+
+def record(name, seconds):
+    with _lock:
+        _timings.append((name, seconds))
+
+
+@contextlib.contextmanager
+def measure(name):
+    """Measures the duration of the with block under name"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def get_timings():
+    """Returns the recorded (name, seconds) tuples in recording order"""
+    with _lock:
+        return list(_timings)
+
+
+def elapsed():
+    """Seconds since the profiler was imported"""
+    return time.perf_counter() - _started_at
+
+
+def report(title='Startup'):
+    """Logs the total time since the start and the slowest steps"""
+    timings = sorted(get_timings(), key=lambda t: t[1], reverse=True)
+    lines = [f'{seconds * 1000:8.1f} ms  {name}'
+             for name, seconds in timings[:REPORT_LIMIT]]
+    logger.info(f'{title} took {elapsed():.2f} s. Slowest steps:\n'
+                + '\n'.join(lines))
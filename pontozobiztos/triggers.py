@@ -0,0 +1,126 @@
+"""Plugin triggers. A plugin can declare the messages it is interested in
+with a module level TRIGGERS list:
+
+    TRIGGERS = [triggers.command('shortcut')]
+
+Available triggers:
+    - command(*names): text starts with '!<name>'
+    - pattern(regex, ignore_case=False): regex found in the text
+    - attachment(*types): message has an attachment of the given type
+    - ALWAYS: every message
+
+Plugins without TRIGGERS are called for every message, an empty list
+means the plugin never gets messages (e.g. scheduled jobs only).
+
+Triggers are only a prefilter: a plugin must still validate the message
+itself, but it won't be called for messages it can't possibly handle.
+"""
+
+import re
+import logging
+
+logger = logging.getLogger("chatbot")
+
+
+class Trigger:
+    def __init__(self, kind, values):
+        self.kind = kind
+        self.values = values
+
+    def __repr__(self):
+        return f'{self.kind}{self.values}'
+
+
+ALWAYS = Trigger('always', ())
+
+
+def command(*names):
+    """Message text starts with '!' followed by one of the names"""
+    return Trigger('command', tuple(n.lower() for n in names))
+
+
+def pattern(regex, ignore_case=False):
+    """Regex is found anywhere in the message text. Use '^' to anchor
+    it to the start of the text. The regex must not use named groups."""
+    return Trigger('pattern', (f'(?i:{regex})' if ignore_case else regex,))
+
+
+def attachment(*types):
+    """Message has at least one attachment of the given types"""
+    return Trigger('attachment', types)
+
+
+class TriggerIndex:
+    """Combined index of every trigger of every plugin. A message is
+    matched against all of them at once: commands with a dict lookup,
+    patterns with a single combined regex, attachments by type."""
+
+    def __init__(self, plugins):
+        """
+        Args:
+            plugins (dict): plugin name -> plugin module
+        """
+        self.plugins = plugins
+        self.always = set()
+        self.commands = {}
+        self.attachments = []
+        self.pattern_owners = []
+        patterns = []
+
+        for name, mod in plugins.items():
+            for trigger in getattr(mod, 'TRIGGERS', [ALWAYS]):
+                if trigger.kind == 'always':
+                    self.always.add(name)
+                elif trigger.kind == 'command':
+                    for cmd in trigger.values:
+                        self.commands.setdefault(cmd, set()).add(name)
+                elif trigger.kind == 'attachment':
+                    self.attachments.append((trigger.values, name))
+                elif trigger.kind == 'pattern':
+                    patterns.append(trigger.values[0])
+                    self.pattern_owners.append(name)
+                else:
+                    logger.warning(f'Unknown trigger {trigger} in {name}')
+
+        # every pattern is an optional lookahead from the start of the text
+        # so one match() call reports all of the patterns that are found
+        self.pattern = re.compile(''.join(
+            f'(?:(?=.*?(?P<p{i}>{p})))?' for i, p in enumerate(patterns)),
+            re.DOTALL) if patterns else None
+
+        logger.info(f'Built trigger index. Always: {sorted(self.always)}, '
+                    f'commands: {sorted(self.commands)}, '
+                    f'patterns: {len(patterns)}, '
+                    f'attachments: {len(self.attachments)}')
+
+    def match(self, message):
+        """Returns the plugins that should receive the message in the
+        order of the plugins dict.
+
+        Args:
+            message (fbchat.MessageData): message to dispatch
+
+        Returns:
+            list: list of (name, module) tuples
+        """
+        names = set(self.always)
+        text = message.text or ''
+
+        if text.startswith('!'):
+            parts = text[1:].split(maxsplit=1)
+            if parts:
+                names |= self.commands.get(parts[0].lower(), set())
+
+        if self.pattern is not None and text:
+            m = self.pattern.match(text)
+            names.update(self.pattern_owners[int(key[1:])]
+                         for key, group in m.groupdict().items()
+                         if group is not None)
+
+        for types, name in self.attachments:
+            if name not in names and any(isinstance(att, types)
+                                         for att in message.attachments):
+                names.add(name)
+
+        return [(name, mod) for name, mod in self.plugins.items()
+                if name in names]
@@ -0,0 +1,128 @@
+"""Shared URL metadata service of the plugins. Every plugin that needs
+the metadata of a posted link (YouTube song details, web page preview)
+asks this module, so one link is fetched once per upstream API:
+
+    - concurrent requests of the same key share one fetch (single-flight)
+    - results are kept for METADATA_TTL seconds, long enough for every
+      plugin handling the same message
+
+There is one YTMusic client for all of the plugins. The plugins extract
+the video id of YouTube links with youtube_video_id, so the different
+forms of a link share the fetch.
+"""
+
+from concurrent.futures import Future
+from pontozobiztos import lazy
+import threading
+import logging
+import time
+import re
+
+logger = logging.getLogger("chatbot")
+
+METADATA_TTL = 60  # seconds
+VIDEO_ID_PATTERN = re.compile(
+    r'^https://(?:(?:www\.|m\.|music\.)?youtube\.com/watch\?(?:.*&)?v=|youtu\.be/)'
+    r'([\w-]+)')
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; WOW64) AppleWebKit/537.36 '
+              '(KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36')
+
+
+def create_ytmusic():
+    import ytmusicapi
+    return ytmusicapi.YTMusic()
+
+
+ytmusic = lazy.LazyObject(create_ytmusic, 'YTMusic client')
+
+# key -> Future of the fetch, in flight or finished
+_requests = {}
+# key -> time.monotonic() the finished result expires at
+_expires = {}
+_lock = threading.Lock()
+
+
+def _fetch(key, func, *args, **kwargs):
+    """Returns the result of func for key. If the same key is being
+    fetched already, waits for that fetch instead of starting another.
+    Failures are not cached, the next call tries again."""
+    now = time.monotonic()
+    with _lock:
+        # drop the expired results
+        for k in [k for k, t in _expires.items() if t <= now]:
+            del _expires[k]
+            del _requests[k]
+        future = _requests.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _requests[key] = future
+
+    if not owner:
+        return future.result()
+
+    try:
+        result = func(*args, **kwargs)
+    except BaseException as e:
+        with _lock:
+            del _requests[key]
+        future.set_exception(e)
+        raise
+    with _lock:
+        _expires[key] = time.monotonic() + METADATA_TTL
+    future.set_result(result)
+    return result
+
+
+def youtube_video_id(url):
+    """Returns the video id of a YouTube or YouTube Music link, None if
+    it's not a video link. Tracking parameters (e.g. youtu.be/<id>?si=)
+    are not part of the id.
+
+    Args:
+        url (str): the link
+
+    Returns:
+        str: id of the video
+    """
+    if match := VIDEO_ID_PATTERN.match(url.strip()):
+        return match.group(1)
+    return None
+
+
+def get_song(video_id):
+    """Returns the YouTube Music details of a video (ytmusic.get_song).
+
+    Args:
+        video_id (str): id of the YouTube video
+
+    Returns:
+        dict: the song details, shared between the callers, don't modify it
+    """
+    return _fetch(('song', video_id), lambda: ytmusic.get_song(video_id))
+
+
+def get_web_preview(url, timeout=2000):
+    """Returns the preview of a web page (webpreview.web_preview).
+
+    Args:
+        url (str): url of the page
+        timeout (int): timeout of the download
+
+    Returns:
+        tuple: (title, description, image url)
+    """
+    def fetch():
+        from webpreview import web_preview
+        return web_preview(url, parser='html.parser', timeout=timeout,
+                           headers={'User-Agent': USER_AGENT})
+
+    return _fetch(('preview', url), fetch)
+
+
+def clear():
+    """Drops every finished result"""
+    with _lock:
+        for key in list(_expires):
+            del _expires[key]
+            del _requests[key]
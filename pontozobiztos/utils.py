@@ -1,54 +1,55 @@
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-import os
-import pathlib
-import glob
-from PIL import Image, UnidentifiedImageError
-import imagehash
 import logging
 import re
 
 log = logging.getLogger('chatbot.utils')
 
 
-def get_season_start():
+def get_season_start(date=None):
     """Calculates season start (10th day 20:00)
 
+    :param date: a date in the season (default: now)
+    :type date: datetime
     :returns: date of season start
     :rtype: datetime
     """
-    today = datetime.today()
+    date = date or datetime.today()
     start_rd = relativedelta(day=10, hour=20, minute=0, second=0, microsecond=0)
-    from_date = today + start_rd
-    if from_date < datetime.today():
+    from_date = date + start_rd
+    if from_date < date:
         return from_date
     else:
         return from_date + relativedelta(months=-1)
 
 
-def get_season_end():
+def get_season_end(date=None):
     """Calculates season end (10th day 20:00)
 
+    :param date: a date in the season (default: now)
+    :type date: datetime
     :returns: date of season end
     :rtype: datetime
     """
-    today = datetime.today()
+    date = date or datetime.today()
     start_rd = relativedelta(day=10, hour=19, minute=50, second=0, microsecond=0)
-    to_date = today + start_rd
-    if to_date > today:
+    to_date = date + start_rd
+    if to_date > date:
         return to_date
     else:
         return to_date + relativedelta(months=1)
 
 
-def get_current_season():
+def get_current_season(date=None):
     """Returns a tuple containing the start and end
-    of the current season.
+    of the current season (or the one containing date).
 
+    :param date: a date in the season (default: now)
+    :type date: datetime
     :returns: (season_start, season_end)
     :rtype: tuple(datetime, datetime)
     """
-    return get_season_start(), get_season_end()
+    return get_season_start(date), get_season_end(date)
 
 
 def get_later_datetime(days, hours, minutes, seconds=0):
@@ -76,30 +77,23 @@ def get_monogram(name):
 
 
 def get_saved_image_path(attachment_id):
-    """Generates a list of paths for a message object where the images
-    are (or will be) stored
+    """Looks up the path where the image of an attachment is stored
+    in the media index.
 
     Args:
         attachment_id (str):
     Returns:
-        pathlib.Path: List of paths of images in message
+        str: media store path of the image, open it with
+            mediastore.open_blob (it's not a local file with every
+            media backend)
     """
-    img_dir = pathlib.Path(os.getenv("IMAGE_DIRECTORY"))
-    image_matches = [x for x in glob.glob(str(img_dir) + '/*a' + attachment_id + '*')]
-    if (li := len(image_matches)) != 1:
-        raise FileNotFoundError(f'Found {li} images with attachment id: {attachment_id}. Expected 1')
-    return pathlib.Path(image_matches[0])
-
-
-def hash_image(image_path: str, hashing_algorithm='phash', **kwargs) -> str:
-    try:
-        image = Image.open(image_path)
-    except UnidentifiedImageError:
-        return ''
-    if hashing_algorithm == 'phash':
-        hash_ = str(imagehash.phash(image, **kwargs))
-        log.info(f'Calculated hash for {image_path}: {hash_}')
-        return hash_
+    # imported here, because chatmongo depends on this module
+    from pontozobiztos import chatmongo
+
+    path = chatmongo.get_media_path(attachment_id)
+    if path is None:
+        raise FileNotFoundError(f'No image found with attachment id: {attachment_id}')
+    return path
 
 
 def replace_mentions(message) -> str: